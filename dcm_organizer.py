@@ -6,12 +6,89 @@
 # Author: Juan F. Pinzon, Academgene LLC
 # 09.2020
 
-import os, shutil, sys, getopt, json, datetime, logging
+import os, shutil, sys, getopt, json, datetime, logging, sqlite3
+import concurrent.futures
 import pydicom
 from tqdm import tqdm
 
+# Only these tags are read by the parallel organizer, never the pixel data
+ORGANIZER_TAGS = ['Modality', 'BodyPartExamined', 'SeriesInstanceUID']
 
-def organizer(SRC, OUT, MODALITY, BODYPART, LOG_FNAME, processed_dcms):
+
+def open_processed_log(LOG_FNAME, OLD_LOG_FNAME=None):
+    # The processed files log is an SQLite table with the file name as its
+    # primary key, so lookups and appends don't depend on the log size and
+    # an interrupted run can't corrupt it.
+    new_log = not os.path.exists(LOG_FNAME)
+    processed_log = sqlite3.connect(LOG_FNAME, timeout=60)
+    processed_log.execute('CREATE TABLE IF NOT EXISTS processed (name TEXT PRIMARY KEY)')
+    processed_log.commit()
+
+    # one time import of the old JSON list log
+    if new_log and OLD_LOG_FNAME and os.path.exists(OLD_LOG_FNAME):
+        try:
+            with open(OLD_LOG_FNAME, 'r') as infile:
+                mark_processed(processed_log, json.load(infile))
+            logging.info('Imported processed files log: ' + OLD_LOG_FNAME)
+        except Exception as e:
+            logging.warning('Could not import old log ' + OLD_LOG_FNAME + ': ' + str(e))
+    return processed_log
+
+def is_processed(processed_log, dcm):
+    return processed_log.execute('SELECT 1 FROM processed WHERE name = ?', (dcm,)).fetchone() is not None
+
+def mark_processed(processed_log, dcms):
+    with processed_log:
+        processed_log.executemany('INSERT OR IGNORE INTO processed VALUES (?)', ((x,) for x in dcms))
+
+# Output modes:
+#   move      - move the files into OUT/<SeriesInstanceUID>/ (default)
+#   hardlink  - hard link them there, leaving the input layout untouched
+#   symlink   - symbolic link them there
+#   manifest  - only write OUT/series_manifest.json, mapping each
+#               SeriesInstanceUID to its files (read by dicom2stl_tuned.py)
+OUTPUT_MODES = ['move', 'hardlink', 'symlink', 'manifest']
+MANIFEST_FNAME = 'series_manifest.json'
+
+def place_file(src_path, out_path, MODE):
+    # Put one file in the per-series tree. Within a filesystem shutil.move
+    # is already a rename.
+    if MODE == 'hardlink':
+        try:
+            os.link(src_path, out_path)
+        except OSError as e:
+            # can't hard link across filesystems
+            logging.warning('Could not hard link ' + src_path + ' (' + str(e) + '), making a symlink instead')
+            os.symlink(os.path.abspath(src_path), out_path)
+    elif MODE == 'symlink':
+        os.symlink(os.path.abspath(src_path), out_path)
+    else:
+        shutil.move(src_path, out_path)
+
+def load_manifest(OUT):
+    try:
+        with open(OUT + MANIFEST_FNAME, 'r') as infile:
+            return json.load(infile)
+    except:
+        return {}
+
+def save_manifest(OUT, manifest):
+    if not os.path.exists(OUT):
+        os.makedirs(OUT)
+    tmp_name = OUT + MANIFEST_FNAME + '.tmp'
+    with open(tmp_name, 'w') as outfile:
+        json.dump(manifest, outfile)
+    os.replace(tmp_name, OUT + MANIFEST_FNAME)
+
+def add_to_manifest(manifest, uid, src_path):
+    # returns True if this is a new series
+    new_series = uid not in manifest
+    if new_series:
+        manifest[uid] = []
+    manifest[uid].append(os.path.abspath(src_path))
+    return new_series
+
+def organizer(SRC, OUT, MODALITY, BODYPART, LOG_FNAME, processed_log, MODE='move', manifest=None):
 
     totalFiles = 0
     counter = 0
@@ -22,7 +99,7 @@ def organizer(SRC, OUT, MODALITY, BODYPART, LOG_FNAME, processed_dcms):
     totalFiles = len(input_dcms)
 
     #excluding already processed files
-    input_dcms = [x for x in input_dcms if x not in processed_dcms]
+    input_dcms = [x for x in input_dcms if not is_processed(processed_log, x)]
 
     for i, dcm in tqdm(enumerate(input_dcms), total=len(input_dcms)):
         try:
@@ -31,10 +108,15 @@ def organizer(SRC, OUT, MODALITY, BODYPART, LOG_FNAME, processed_dcms):
                 out_dir = OUT + ds.SeriesInstanceUID
                 src_path = SRC + dcm
                 out_path = out_dir + '/' + dcm
+                if MODE == 'manifest':
+                    if add_to_manifest(manifest, ds.SeriesInstanceUID, src_path):
+                        UID_count += 1
+                    counter += 1
+                    continue
                 if not os.path.exists(out_dir):
                     os.makedirs(out_dir)
                     UID_count += 1
-                shutil.move(src_path, out_path)
+                place_file(src_path, out_path, MODE)
                 counter += 1
                 #if ds.SeriesInstanceUID not in seriesUID: 
                 #    seriesUID.append(ds.SeriesInstanceUID)  
@@ -45,15 +127,79 @@ def organizer(SRC, OUT, MODALITY, BODYPART, LOG_FNAME, processed_dcms):
     
     return input_dcms, counter, error_count, totalFiles, UID_count
 
+def read_tags(src_path):
+    # Header only read of the organizer tags. Returns None on any error,
+    # (e.g. not a DICOM file or a missing tag), like the serial organizer.
+    try:
+        ds = pydicom.dcmread(src_path, stop_before_pixels=True, specific_tags=ORGANIZER_TAGS)
+        return ds.Modality, ds.BodyPartExamined, ds.SeriesInstanceUID
+    except Exception:
+        return None
+
+def organizer_parallel(SRC, OUT, MODALITY, BODYPART, LOG_FNAME, processed_log, JOBS, MODE='move', manifest=None):
+    # Parallel version of organizer(): headers are read in a process pool
+    # and output directories are created in one batch.
+
+    counter = 0
+    error_count = 0
+    UID_count = 0
+
+    input_dcms = os.listdir(SRC)
+    totalFiles = len(input_dcms)
+
+    #excluding already processed files
+    input_dcms = [x for x in input_dcms if not is_processed(processed_log, x)]
+    src_paths = [SRC + dcm for dcm in input_dcms]
+
+    chunk = max(1, len(src_paths) // (8 * JOBS))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=JOBS) as pool:
+        tags = list(tqdm(pool.map(read_tags, src_paths, chunksize=chunk), total=len(src_paths)))
+
+    # pick the files to move and batch the directory creation
+    moves = []
+    for dcm, tag in zip(input_dcms, tags):
+        if tag is None:
+            error_count += 1
+        elif tag[0] == MODALITY and tag[1] == BODYPART:
+            moves.append((dcm, tag[2]))
+
+    if MODE == 'manifest':
+        for dcm, uid in moves:
+            if add_to_manifest(manifest, uid, SRC + dcm):
+                UID_count += 1
+        return input_dcms, len(moves), error_count, totalFiles, UID_count
+
+    if not os.path.exists(OUT):
+        os.makedirs(OUT)
+    for uid in set(uid for dcm, uid in moves):
+        out_dir = OUT + uid
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+            UID_count += 1
+
+    for dcm, uid in moves:
+        src_path = SRC + dcm
+        out_path = OUT + uid + '/' + dcm
+        try:
+            place_file(src_path, out_path, MODE)
+            counter += 1
+        except Exception as e:
+            error_count += 1
+
+    return input_dcms, counter, error_count, totalFiles, UID_count
+
 def main(argv):
 
     start = datetime.datetime.now()
 
-    LOG_FNAME = os.getcwd() + '/logs/organized_dcms.log'
+    LOG_FNAME = os.getcwd() + '/logs/organized_dcms.db'
+    OLD_LOG_FNAME = os.getcwd() + '/logs/organized_dcms.log'
     #seriesUID = []
     SUBDIRS = False
     BODYPART = 'HEAD'
     MODALITY = 'CT'
+    JOBS = 1
+    MODE = 'move'
 
     # Setting up Logging
 
@@ -79,23 +225,18 @@ def main(argv):
     logging.getLogger().addHandler(console)
 
     #loading the log file in order to exclude already processed series
-    try:
-        with open(LOG_FNAME, 'r') as infile:
-            processed_dcms = set(json.load(infile))
-    except:
-        processed_dcms = set()
-    #print(processed_dcms)
+    processed_log = open_processed_log(LOG_FNAME, OLD_LOG_FNAME)
 
     try:
-        opts, args = getopt.getopt(argv,"hi:o:s:b:m:",["ifolder=","ofolder=","subdirs","bodypart=", "modality="])
+        opts, args = getopt.getopt(argv,"hi:o:s:b:m:j:",["ifolder=","ofolder=","subdirs","bodypart=", "modality=", "jobs=", "mode="])
     except getopt.GetoptError:
-        print('USAGE: dcm_organizer.py -i <input_dicom_folder> -o <output_folder> -s <files are in subdirs> -b <BodyPart> -m <Modality>')
+        print('USAGE: dcm_organizer.py -i <input_dicom_folder> -o <output_folder> -s <files are in subdirs> -b <BodyPart> -m <Modality> -j <parallel jobs> --mode <move|hardlink|symlink|manifest>')
         sys.exit()
         exit()
 
     for opt, arg in opts:
         if opt == '-h':
-            print('USAGE: dcm_organizer.py -i <input_dicom_folder> -o <output_folder> -s <files are in subdirs> -b <BodyPart> -m <Modality>')
+            print('USAGE: dcm_organizer.py -i <input_dicom_folder> -o <output_folder> -s <files are in subdirs> -b <BodyPart> -m <Modality> -j <parallel jobs> --mode <move|hardlink|symlink|manifest>')
             sys.exit()
         elif opt in ("-i", "--ifolder"):
             SRC = arg
@@ -107,9 +248,23 @@ def main(argv):
             BODYPART = str(arg)
         elif opt in ("-m", "--modality"):
             MODALITY = str(arg)
+        elif opt in ("-j", "--jobs"):
+            JOBS = int(arg)
+        elif opt == "--mode":
+            MODE = str(arg)
+            if MODE not in OUTPUT_MODES:
+                print('Unknown output mode: ' + MODE + ', use one of ' + str(OUTPUT_MODES))
+                sys.exit()
 
     #print(BODYPART, MODALITY)
 
+    manifest = load_manifest(OUT) if MODE == 'manifest' else None
+
+    def organize(SRC_dir):
+        if JOBS > 1:
+            return organizer_parallel(SRC_dir, OUT, MODALITY, BODYPART, LOG_FNAME, processed_log, JOBS, MODE, manifest)
+        return organizer(SRC_dir, OUT, MODALITY, BODYPART, LOG_FNAME, processed_log, MODE, manifest)
+
     # call organizer function:
     if SUBDIRS:
         counter, error_count, totalFiles, UID_count = 0, 0, 0, 0
@@ -118,25 +273,25 @@ def main(argv):
             logging.info('Procesing Directory: ' + sub_dir)
             #seriesUID = []
             SRC_subdir = SRC + sub_dir + '/'
-            input_dcms_subdir, counter_subdir, error_count_subdir, totalFiles_subdir, UID_count_subdir = organizer(SRC_subdir, \
-                OUT, MODALITY, BODYPART, LOG_FNAME, processed_dcms)
+            input_dcms_subdir, counter_subdir, error_count_subdir, totalFiles_subdir, UID_count_subdir = organize(SRC_subdir)
             # updating and writing the log
-            processed_dcms.update(input_dcms_subdir)
-            with open(LOG_FNAME, 'w') as infile:
-                json.dump(list(processed_dcms), infile)
+            if manifest is not None:
+                save_manifest(OUT, manifest)
+            mark_processed(processed_log, input_dcms_subdir)
             #seriesUID.append(seriesUID_subdir)
             counter += counter_subdir
             error_count += error_count_subdir
             totalFiles += totalFiles_subdir
             UID_count += UID_count_subdir
     else:
-        input_dcms, counter, error_count, totalFiles, UID_count = organizer(SRC, OUT, MODALITY, BODYPART, LOG_FNAME, processed_dcms)
-        processed_dcms.update(input_dcms)
-        with open(LOG_FNAME, 'w') as infile:
-            json.dump(list(processed_dcms), infile)
+        input_dcms, counter, error_count, totalFiles, UID_count = organize(SRC)
+        if manifest is not None:
+            save_manifest(OUT, manifest)
+        mark_processed(processed_log, input_dcms)
+    processed_log.close()
 
     # updating and writing the log
-    #processed_dcms.update(input_dcms)
+    #mark_processed(processed_log, input_dcms)
         
     logging.info('')
     logging.info(str(totalFiles) + ' files scanned')
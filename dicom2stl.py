@@ -23,6 +23,7 @@ Novosibirsk, Russia
 from __future__ import print_function
 import sys, os, getopt, time, gc, glob, math, datetime
 import zipfile, tempfile
+import concurrent.futures
 
 begin_time = datetime.datetime.now()
 
@@ -36,13 +37,32 @@ dicomString = ""
 cleanUp = False
 tempDir = ""
 dirFlag = False
+indexFile = ""
+indexFlag = True
+decodeJobs = 1
+numThreads = 0
+pixelType = None
+memReport = False
 
 isovalue = 0
+isovalues = [0.0]
 CTonly = False
 doubleThreshold = False
 thresholds = []
+thresholdSets = []
 tissueType = ""
 shrinkFlag = True
+cropFlag = True
+voxelSize = None
+maxVoxels = None
+isotropicFlag = False
+antialiasFlag = True
+slabSize = 0
+medianRadius = [3, 3, 1]
+surfaceEngine = "auto"
+streamSlab = 0
+numLabels = 0
+numComponents = 1
 
 smoothIterations = 25
 quad = .90
@@ -80,15 +100,31 @@ def usage():
     print("  -c, --clean         Clean up temp files")
     print("  -T string, --temp string      Directory to place temporary files")
     print("  -s string, --search string    Dicom series search string")
+    print("  --index string      Persistent Dicom series index file (default=user cache dir)")
+    print("  -j int, --jobs int  Decode Dicom slices with this many workers (default=1)")
+    print("  --threads int       Number of threads for the SimpleITK and VTK filters (default=all cores)")
+    print("  --pixeltype string  Keep the volume as int16 or float32, rather than float64 for rescaled data")
     print("")
     print("  Volume processing options")
     print(
-        "  -t string, --type string      CT Tissue type [skin, bone, soft_tissue, fat]")
+        "  -t string, --type string      CT Tissue type [skin, bone, soft_tissue, fat], comma separated for several")
     print("  -a, --anisotropic             Apply anisotropic smoothing to the volume")
-    print("  -i num, --isovalue num        Iso-surface value")
-    print("  -d string, --double string    Double threshold with 4 values in a string seperated by semicolons")
+    print("  --slab int          Smooth the volume in z-slabs of this many slices (default=0, whole volume)")
+    print("  --median string     Apply a median filter with this radius, comma separated (default=3,3,1)")
+    print("  -i num, --isovalue num        Iso-surface value, or several seperated by semicolons")
+    print("  -d string, --double string    Double threshold with 4 values in a string seperated by semicolons,")
+    print("                                may be repeated for several threshold sets")
+    print("  --voxelsize float   Resample the volume to this voxel size (replaces the 256 cubed shrink)")
+    print("  --maxvoxels int     Resample the volume to at most this many voxels")
     print("")
     print("  Mesh options")
+    print("  --stream int        Contour a Dicom directory in z-slabs of this many slices, without loading")
+    print("                      the whole volume (isovalue only, full resolution, no resampling)")
+    print("  --components int    Keep the int largest objects, picked in the volume before contouring,")
+    print("                      as well as by their mesh regions (implies largest)")
+    print("  --labels int        Label the connected objects and write the surfaces of the int largest")
+    print("                      to their own files, from one discrete contouring pass")
+    print("  --engine string     Isosurface engine [auto, flyingedges, synctemplates, marchingcubes, contour] (default=auto)")
     print("  --rotaxis int       Rotation axis (default=1, Y-axis)")
     print("  --rotangle float    Rotation angle (default=180 degrees)")
     print("  --smooth int        Smoothing iterations (default=25)")
@@ -96,20 +132,20 @@ def usage():
     print("")
     print("  Enable/Disable various filtering options")
     print(
-        "  --disable string    Disable an option [anisotropic, shrink, median, largest, rotation]")
+        "  --disable string    Disable an option [anisotropic, shrink, crop, median, largest, rotation, index, isotropic, antialias, memreport]")
     print(
-        "  --enable  string    Enable an option [anisotropic, shrink, median, largest, rotation]")
+        "  --enable  string    Enable an option [anisotropic, shrink, crop, median, largest, rotation, index, isotropic, antialias, memreport]")
 
 
 # Parse the command line arguments
 #
 
 try:
-    opts, args = getopt.getopt(sys.argv[1:], "vDhacli:s:t:d:o:m:T:",
+    opts, args = getopt.getopt(sys.argv[1:], "vDhacli:s:t:d:o:m:T:j:",
                                ["verbose", "help", "debug", "anisotropic", "clean", "ct", "isovalue=", "search=", "type=",
                                 "double=", "disable=", "enable=", "largest", "metadata", "rotaxis=", "rotangle=", "smooth=",
 
-                                "reduce=", "temp="])
+                                "reduce=", "temp=", "index=", "jobs=", "voxelsize=", "maxvoxels=", "slab=", "median=", "threads=", "engine=", "pixeltype=", "stream=", "labels=", "components="])
 except getopt.GetoptError as err:
     print(str(err))
     usage()
@@ -130,10 +166,46 @@ for o, a in opts:
         cleanUp = True
     elif o in ("-T", "--temp"):
         tempDir = a
+    elif o == "--index":
+        indexFile = a
+    elif o in ("-j", "--jobs"):
+        decodeJobs = int(a)
+    elif o == "--threads":
+        numThreads = int(a)
+    elif o == "--engine":
+        from utils import vtkutils
+        if a != "auto" and a not in vtkutils.ENGINES:
+            print("Error: unknown isosurface engine.", a)
+            sys.exit(2)
+        surfaceEngine = a
+    elif o == "--components":
+        numComponents = int(a)
+        connectivityFilter = True
+    elif o == "--labels":
+        numLabels = int(a)
+    elif o == "--stream":
+        streamSlab = int(a)
+    elif o == "--pixeltype":
+        if a not in ("int16", "float32"):
+            print("Error: pixel type must be int16 or float32.", a)
+            sys.exit(2)
+        pixelType = a
+    elif o == "--voxelsize":
+        voxelSize = float(a)
+    elif o == "--maxvoxels":
+        maxVoxels = int(float(a))
+    elif o == "--slab":
+        slabSize = int(a)
+    elif o == "--median":
+        medianRadius = [int(r) for r in a.split(',')]
+        if len(medianRadius) == 1:
+            medianRadius = medianRadius * 3
+        medianFilter = True
     elif o in ("-a", "--anisotropic"):
         anisotropicSmoothing = True
     elif o in ("-i", "--isovalue"):
-        isovalue = float(a)
+        isovalues = [float(v) for v in a.split(';')]
+        isovalue = isovalues[0]
     elif o in ("--ct"):
         CTonly = True
     elif o in ("-l", "--largest"):
@@ -149,9 +221,11 @@ for o, a in opts:
         metadataFile = a
     elif o in ("-d", "--double"):
         vals = a.split(';')
+        thresholds = []
         for v in vals:
             thresholds.append(float(v))
         thresholds.sort()
+        thresholdSets.append(thresholds)
         doubleThreshold = True
     elif o in ("--rotaxis"):
         rotAxis = int(a)
@@ -178,6 +252,8 @@ for x in options:
         y = x[2:]
     if y.startswith("shrink"):
         shrinkFlag = val
+    if y.startswith("crop"):
+        cropFlag = val
     if y.startswith("aniso"):
         anisotropicSmoothing = val
     if y.startswith("median"):
@@ -186,6 +262,14 @@ for x in options:
         connectivityFilter = val
     if y.startswith("rotat"):
         rotFlag = val
+    if y.startswith("index"):
+        indexFlag = val
+    if y.startswith("isotrop"):
+        isotropicFlag = val
+    if y.startswith("antialias"):
+        antialiasFlag = val
+    if y.startswith("memrep"):
+        memReport = val
 
 
 print("")
@@ -193,29 +277,44 @@ if tempDir == "":
     tempDir = tempfile.mkdtemp()
 print("Temp dir: ", tempDir)
 
+# Each tissue is [name, thresholds, median filter flag].  Thresholds of
+# None mean the surface is extracted at the isovalue.
+#
+tissues = []
+
 if tissueType:
-    # Convert tissue type name to threshold values
-    print("Tissue type: ", tissueType)
-    if tissueType.find("bone") > -1:
-        thresholds = [150., 800., 1500., 2000.]  #default values: [200., 800., 1300., 1500.]
-    elif tissueType.find("skin") > -1:
-        thresholds = [-200., 0., 500., 1500.]
-    elif tissueType.find("soft") > -1:
-        thresholds = [-15., 30., 58., 100.]
-        medianFilter = True
-    elif tissueType.find("fat") > -1:
-        thresholds = [-122., -112., -96., -70.]
-        medianFilter = True
+    # Convert tissue type names to threshold values
+    for tt in tissueType.split(','):
+        print("Tissue type: ", tt)
+        if tt.find("bone") > -1:
+            tissues.append(["bone", [150., 800., 1500., 2000.], medianFilter])  #default values: [200., 800., 1300., 1500.]
+        elif tt.find("skin") > -1:
+            tissues.append(["skin", [-200., 0., 500., 1500.], medianFilter])
+        elif tt.find("soft") > -1:
+            tissues.append(["soft", [-15., 30., 58., 100.], True])
+        elif tt.find("fat") > -1:
+            tissues.append(["fat", [-122., -112., -96., -70.], True])
+        else:
+            print("Error: unknown tissue type.", tt)
+            sys.exit(3)
+
+for i, thresholds in enumerate(thresholdSets):
+    tissues.append(["double" + str(i+1), thresholds, medianFilter])
 
+if numLabels and len(isovalues) > 1 and not doubleThreshold:
+    print("Error: --labels takes a single isovalue.")
+    sys.exit(2)
 
 if doubleThreshold:
-    # check that there are 4 threshold values.
-    print("Thresholds: ", thresholds)
-    if len(thresholds) != 4:
-        print("Error: Threshold is not of size 4.", thresholds)
-        sys.exit(3)
+    for name, thresholds, median in tissues:
+        # check that there are 4 threshold values.
+        print("Thresholds: ", thresholds)
+        if len(thresholds) != 4:
+            print("Error: Threshold is not of size 4.", thresholds)
+            sys.exit(3)
 else:
-    print("Isovalue = ", isovalue)
+    print("Isovalue = ", isovalues if len(isovalues) > 1 else isovalue)
+    tissues.append(["iso", None, medianFilter])
 
 
 fname = args
@@ -249,6 +348,119 @@ dcmnames = []
 metasrc = img
 
 from utils import dicomutils
+from utils import sitkutils
+from utils import threads
+
+if numThreads:
+    print("Threads: ", threads.setNumberOfThreads(numThreads))
+
+if not indexFlag:
+    indexFile = None
+elif indexFile == "":
+    indexFile = dicomutils.defaultIndexFile()
+
+
+def finishMesh(mesh, filename, largest=None):
+    """
+    Clean, smooth, reduce and rotate a mesh, and write it out.  largest
+    is the number of largest mesh regions to keep, or False for all
+    (default numComponents with connectivityFilter).
+    """
+    if largest is None:
+        largest = numComponents if connectivityFilter else False
+    if debug:
+        print("Cleaning mesh")
+    mesh2 = vtkutils.cleanMesh(mesh, largest)
+    mesh = None
+    gc.collect()
+    if debug:
+        print("Smoothing mesh", smoothIterations, "iterations")
+    mesh3 = vtkutils.smoothMesh(mesh2, smoothIterations)
+    mesh2 = None
+    gc.collect()
+    if debug:
+        print("Simplifying mesh")
+    mesh4 = vtkutils.reduceMesh(mesh3, quad)
+    mesh3 = None
+    gc.collect()
+
+    if rotFlag:
+        mesh5 = vtkutils.rotateMesh(mesh4, rotAxis, rotAngle)
+    else:
+        mesh5 = mesh4
+    vtkutils.writeMesh(mesh5, filename)
+    mesh4 = None
+    gc.collect()
+
+
+# Stream the largest series of a directory through the contouring a z-slab
+# at a time, at full resolution, for volumes that don't fit in memory.  The
+# smoothing and median filters run on each slab plus a halo of slices.  The
+# median then matches the whole-volume filter, but the anisotropic diffusion
+# scales its conductance per slab, so it can differ slightly.  Resampling
+# and the threshold and label stages need the whole volume.  Cropping would
+# only skip empty space, so it isn't needed.
+#
+if streamSlab:
+    if not dirFlag or doubleThreshold or numLabels:
+        print("Error: --stream needs a Dicom directory and an isovalue.")
+        sys.exit(2)
+    if voxelSize or maxVoxels or isotropicFlag:
+        print("Error: --stream can't be combined with resampling.")
+        sys.exit(2)
+    ss = dicomutils.largestSeries(dicomutils.indexDicomDir(fname[0], indexFile=indexFile))
+    if ss is None:
+        print("Error:  no series found")
+        sys.exit(4)
+    modality = dicomutils.getDicomTags(ss[2][0]).get("Modality", "")
+    if CTonly and modality.find("CT") == -1:
+        print("Imaging modality is not CT.  Exiting.")
+        sys.exit(1)
+
+    import vtk
+    from utils import vtkutils
+
+    print("\nStreaming series", ss[0], "in slabs of", streamSlab, "slices")
+    readSlab, dims, origin, spacing = dicomutils.seriesSlabReader(ss, pixelType, decodeJobs)
+
+    if anisotropicSmoothing or medianFilter:
+        diffusionIterations = 5
+
+        def preprocess(slab):
+            if anisotropicSmoothing:
+                slab = sitkutils.anisotropicDiffusion(slab, .03, diffusionIterations)
+            if medianFilter:
+                slab = sitk.Median(slab, medianRadius)
+            return slab
+
+        halo = (sitkutils.diffusionHalo(diffusionIterations) if anisotropicSmoothing else 0) + \
+            (medianRadius[2] if medianFilter else 0)
+        print("Slab filters:", "anisotropic" if anisotropicSmoothing else "",
+              "median" if medianFilter else "", ", halo", halo)
+        readSlab = sitkutils.filteredSlabReader(readSlab, dims[2], preprocess, halo, spacing)
+
+    # every isovalue is contoured from each slab, so the series is read once
+    meshes = vtkutils.extractSurfaceStreamed(readSlab, dims, spacing, origin, list(isovalues),
+                                             streamSlab, 5, engine=surfaceEngine)
+    if memReport:
+        sitkutils.memoryReport("surface")
+    base, ext = os.path.splitext(outname)
+    for i in range(len(meshes)):
+        mesh, meshes[i] = meshes[i], None
+        if len(isovalues) > 1:
+            finishMesh(mesh, base + "_" + ("%g" % isovalues[i]) + ext)
+        else:
+            finishMesh(mesh, outname)
+        mesh = None
+
+    if cleanUp:
+        import shutil
+        shutil.rmtree(tempDir)
+    print("")
+    print('Execution Time: ', datetime.datetime.now() - begin_time)
+    print("")
+    sys.exit(0)
+
 
 #  Load our Dicom data
 #
@@ -256,7 +468,7 @@ if zipFlag:
     # Case for a zip file of images
     if verbose:
         print("zip")
-    img, modality = dicomutils.loadZipDicom(fname[0], tempDir)
+    img, modality = dicomutils.loadZipDicom(fname[0], tempDir, pixelType)
 
 
 else:
@@ -264,7 +476,8 @@ else:
         if verbose:
             print("directory")
             print(fname[0])
-        img, modality = dicomutils.loadLargestSeries(fname[0])
+        img, modality = dicomutils.loadLargestSeries(fname[0], indexFile,
+                                                     decodeJobs, pixelType)
 
     else:
         # Case for a single volume image
@@ -273,6 +486,8 @@ else:
                 print("Reading volume: ", fname[0])
             img = sitk.ReadImage(fname[0])
             modality = dicomutils.getModality(img)
+            if pixelType:
+                img = dicomutils.compactImage(img, pixelType)
 
         else:
             # Case for a series of image files
@@ -286,8 +501,13 @@ else:
             isr = sitk.ImageSeriesReader()
             isr.SetFileNames(fname)
             img = isr.Execute()
-            firstslice = sitk.ReadImage(fname[0])
-            modality = dicomutils.getModality(firstslice)
+            tags = dicomutils.getDicomTags(fname[0]) or {}
+            modality = tags.get("Modality", "")
+            if pixelType:
+                img = dicomutils.compactImage(img, pixelType)
+
+if memReport:
+    sitkutils.memoryReport("load", img)
 
 if CTonly and ((sitk.Version.MinorVersion() > 8) or (sitk.Version.MajorVersion() > 0)):
     # Check the metadata for CT image type.  Note that this only works with
@@ -307,7 +527,7 @@ def roundThousand(x):
 
 
 def elapsedTime(start_time):
-    dt = roundThousand(time.clock()-start_time)
+    dt = roundThousand(time.perf_counter()-start_time)
     print("    ", dt, "seconds")
 
 
@@ -327,8 +547,12 @@ if len(metadataFile):
 
 
 #
-# shrink the volume to 256 cubed
-if shrinkFlag:
+# resample the volume to the requested voxel size or voxel budget,
+# otherwise shrink the volume to 256 cubed
+if voxelSize or maxVoxels or isotropicFlag:
+    img = sitkutils.resampleVolume(img, voxelSize, maxVoxels, isotropicFlag, antialiasFlag)
+
+elif shrinkFlag:
     sfactor = []
     size = img.GetSize()
     sum = 0
@@ -339,7 +563,7 @@ if shrinkFlag:
 
     if sum > 3:
         # if sum==3, no shrink happens
-        t = time.clock()
+        t = time.perf_counter()
         print("Shrink factors: ", sfactor)
         img = sitk.Shrink(img, sfactor)
         newsize = img.GetSize()
@@ -347,114 +571,212 @@ if shrinkFlag:
         elapsedTime(t)
 
 gc.collect()
+if memReport:
+    sitkutils.memoryReport("shrink", img)
 
 
-# Apply anisotropic smoothing to the volume image.  That's a smoothing filter
-# that preserves edges.
+# Crop the volume to the region that can hold the surfaces, the bounding box
+# of the voxels in range at full resolution, so the filters and contouring
+# below skip empty space.  After a median of radius r a surface can reach
+# r+1 voxels past the box, and the median there looks r voxels further, so
+# a margin of 2r+1 gives the same surfaces as the uncropped volume.
 #
-if anisotropicSmoothing:
-    print("Anisotropic Smoothing")
-    t = time.clock()
-    pixelType = img.GetPixelID()
-    img = sitk.Cast(img, sitk.sitkFloat32)
-    img = sitk.CurvatureAnisotropicDiffusion(img, .03)
-    img = sitk.Cast(img, pixelType)
-    elapsedTime(t)
-    gc.collect()
+cropMargin = [2*r + 1 if any(x[2] for x in tissues) else 1 for r in medianRadius]
 
-# Apply the double threshold filter to the volume
-#
-if doubleThreshold:
-    print("Double Threshold")
-    t = time.clock()
-    img = sitk.DoubleThreshold(
-        img, thresholds[0], thresholds[1], thresholds[2], thresholds[3], 255, 0)
-    isovalue = 64.0
-    elapsedTime(t)
-    gc.collect()
 
-# Apply a 3x3x1 median filter.  I only use 1 in the Z direction so it's not so slow.
-#
-if medianFilter:
-    print("Median filter")
-    t = time.clock()
-    img = sitk.Median(img, [3, 3, 1])
-    elapsedTime(t)
+def cropVolume(img):
+    if doubleThreshold:
+        img = sitkutils.autoCrop(img, min([x[1][0] for x in tissues]),
+                                 max([x[1][3] for x in tissues]), cropMargin)
+    else:
+        img = sitkutils.autoCrop(img, min(isovalues), margin=cropMargin)
     gc.collect()
+    if memReport:
+        sitkutils.memoryReport("crop", img)
+    return img
 
-# Pad black to the boundaries of the image
-#
-pad = [5, 5, 5]
-img = sitk.ConstantPad(img, pad, pad)
-gc.collect()
 
-if verbose:
-    print("\nImage for isocontouring")
-    print(img.GetSize())
-    print(img.GetPixelIDTypeAsString())
-    print(img.GetSpacing())
-    print(img.GetOrigin())
-    if verbose > 1:
-        print(img)
-    print("")
+# The anisotropic diffusion scales its conductance by the gradients of the
+# whole volume, so cropping first would change the smoothed values.  Without
+# it the crop comes first.
+#
+if cropFlag and not anisotropicSmoothing:
+    img = cropVolume(img)
 
-#vtkname =  tempDir+"/vol.vtk"
-#sitk.WriteImage( img, vtkname )
 
-import platform
-from utils import sitk2vtk
-import vtk
-vtkimg = None
-
-if platform.system() is "Windows":
-    # hacky work-around to avoid a crash on Windows
-    vtkimg = vtk.vtkImageData()
-    vtkimg.SetDimensions(10, 10, 10)
-    vtkimg.AllocateScalars(vtk.VTK_CHAR, 1)
-    sitk2vtk.sitk2vtk(img, vtkimg, False)
-else:
-    vtkimg = sitk2vtk.sitk2vtk(img)
+# Apply anisotropic smoothing to the volume image.  That's a smoothing filter
+# that preserves edges.
+#
+if anisotropicSmoothing:
+    print("Anisotropic Smoothing")
+    img = sitkutils.anisotropicDiffusion(img, .03, slab=slabSize)
+    gc.collect()
+    if memReport:
+        sitkutils.memoryReport("anisotropic", img)
+    if cropFlag:
+        img = cropVolume(img)
 
-img = None
-gc.collect()
 
+import platform
 import traceback
 import vtk
+from utils import sitk2vtk
+from utils import vtkutils
 
 if debug:
     print("\nVTK version: ", vtk.vtkVersion.GetVTKVersion())
     print("VTK: ", vtk, "\n")
 
 
-from utils import vtkutils
+def tissueOutname(name, value=None, label=None):
+    """
+    Output file name for a tissue, result_bone.stl for result.stl, with
+    the isovalue added when there are several, result_150.stl, and the
+    label of an object, result_label1.stl.
+    """
+    base, ext = os.path.splitext(outname)
+    if len(tissues) > 1:
+        base = base + "_" + name
+    if value is not None:
+        base = base + "_" + ("%g" % value)
+    if label is not None:
+        base = base + "_label" + str(label)
+    return base + ext
+
+
+def extractTissue(img, name, thresholds, median):
+    """Threshold, pad and mesh one tissue of the volume, and write the meshes."""
+    values = isovalues
+
+    if thresholds:
+        if cropFlag and len(tissues) > 1:
+            img = sitkutils.autoCrop(img, thresholds[0], thresholds[3], cropMargin)
+
+        # Apply the double threshold filter, the median filter and the padding
+        # to the volume.  The median votes straight into the padded uint8 output
+        #
+        print("Double Threshold" + (" + Median filter" if median else "") + " + Pad")
+        img = sitkutils.thresholdMedianPad(img, thresholds,
+                                           medianRadius if median else None, 5)
+        values = [64.0]
+        gc.collect()
+
+    else:
+        # Apply a median filter, 3x3x1 by default.  A binary volume gets the
+        # much cheaper majority vote, which gives the same result.
+        #
+        if median:
+            print("Median filter", medianRadius)
+            binary = sitkutils.isBinary(img)
+            if binary is not None:
+                img = sitkutils.majorityFilter(img, medianRadius, binary)
+            else:
+                t = time.perf_counter()
+                img = sitk.Median(img, medianRadius)
+                elapsedTime(t)
+            gc.collect()
+
+    # Drop the smaller objects in the volume, so they are never contoured.
+    # The mesh connectivity filter still runs, on the much smaller mesh,
+    # since one object can hold several surfaces, such as closed internal
+    # cavities.  The regions differ with the isovalue, so several
+    # isovalues are left to the mesh filter alone.
+    #
+    if connectivityFilter and not numLabels and len(values) == 1:
+        img = sitkutils.keepLargestComponents(img, values[0], count=numComponents)
+        gc.collect()
+
+    if numLabels:
+        # Label the connected objects, largest first, so each gets its own
+        # surface from a single discrete contouring pass
+        #
+        img, sizes = sitkutils.labelComponents(img, values[0], maxLabels=numLabels)
+        values = list(range(1, len(sizes) + 1))
+        gc.collect()
+
+    if not thresholds:
+        # Pad black to the boundaries of the image
+        #
+        pad = [5, 5, 5]
+        img = sitk.ConstantPad(img, pad, pad)
+        gc.collect()
+
+    if memReport:
+        sitkutils.memoryReport(name + " mask", img)
+
+    if verbose:
+        print("\nImage for isocontouring")
+        print(img.GetSize())
+        print(img.GetPixelIDTypeAsString())
+        print(img.GetSpacing())
+        print(img.GetOrigin())
+        if verbose > 1:
+            print(img)
+        print("")
+
+    #vtkname =  tempDir+"/vol.vtk"
+    #sitk.WriteImage( img, vtkname )
+
+    vtkimg = None
+
+    if platform.system() == "Windows":
+        # hacky work-around to avoid a crash on Windows
+        vtkimg = vtk.vtkImageData()
+        vtkimg.SetDimensions(10, 10, 10)
+        vtkimg.AllocateScalars(vtk.VTK_CHAR, 1)
+        sitk2vtk.sitk2vtk(img, vtkimg, False)
+    else:
+        vtkimg = sitk2vtk.sitk2vtk(img)
+
+    img = None
+    gc.collect()
+
+    if debug:
+        print("Extracting surface")
+    if numLabels:
+        meshes = vtkutils.extractLabelSurfaces(vtkimg, values)
+    else:
+        # the surfaces for several isovalues are contoured concurrently
+        meshes = vtkutils.extractSurface(vtkimg, values, surfaceEngine)
+    vtkimg = None
+    gc.collect()
+    if memReport:
+        sitkutils.memoryReport(name + " surface")
+
+    for i in range(len(meshes)):
+        mesh, meshes[i] = meshes[i], None
+        if numLabels:
+            finishMesh(mesh, tissueOutname(name, label=values[i]), False)
+        else:
+            finishMesh(mesh, tissueOutname(name, values[i] if len(values) > 1 else None))
+        mesh = None
+    meshes = None
 
-if debug:
-    print("Extracting surface")
-mesh = vtkutils.extractSurface(vtkimg, isovalue)
-vtkimg = None
-gc.collect()
-if debug:
-    print("Cleaning mesh")
-mesh2 = vtkutils.cleanMesh(mesh, connectivityFilter)
-mesh = None
-gc.collect()
-if debug:
-    print("Smoothing mesh", smoothIterations, "iterations")
-mesh3 = vtkutils.smoothMesh(mesh2, smoothIterations)
-mesh2 = None
-gc.collect()
-if debug:
-    print("Simplifying mesh")
-mesh4 = vtkutils.reduceMesh(mesh3, quad)
-mesh3 = None
-gc.collect()
 
-if rotFlag:
-    mesh5 = vtkutils.rotateMesh(mesh4, rotAxis, rotAngle)
+# Extract the tissues from the shared volume, several at once when there
+# is the memory for it.  A tissue needs a few uint8 copies of the padded
+# volume, plus its mesh.
+#
+tissueJobs = 1
+if len(tissues) > 1:
+    perTissue = 8 * img.GetNumberOfPixels()
+    tissueJobs = sitkutils.memoryLimitedWorkers(perTissue, len(tissues))
+    if numThreads:
+        tissueJobs = min(tissueJobs, numThreads)
+    print("Extracting", len(tissues), "tissues with", tissueJobs, "workers")
+
+if tissueJobs > 1:
+    # each worker gets its own image object, a shallow copy that shares the
+    # pixel buffer, so no two threads use the same sitk.Image at once
+    with concurrent.futures.ThreadPoolExecutor(tissueJobs) as pool:
+        futures = [pool.submit(extractTissue, sitk.Image(img), *x) for x in tissues]
+        for f in futures:
+            f.result()
 else:
-    mesh5 = mesh4
-vtkutils.writeMesh(mesh5, outname)
-mesh4 = None
+    for x in tissues:
+        extractTissue(img, *x)
+
+img = None
 gc.collect()
 
 
@@ -27,7 +27,7 @@ Novosibirsk, Russia
 
 from __future__ import print_function
 import sys, os, getopt, time, gc, glob, math, datetime, logging
-import zipfile, tempfile, shutil, pydicom, json
+import zipfile, tempfile, shutil, json
 import SimpleITK as sitk
 import vtk
 import platform
@@ -36,6 +36,9 @@ import traceback
 from utils import dicomutils
 from utils import sitk2vtk
 from utils import vtkutils
+from utils import sitkutils
+from utils import threads
+from utils import volumecache
 
 start = datetime.datetime.now()
 
@@ -49,18 +52,35 @@ dicomString = ""
 cleanUp = True
 tempDir = ""
 dirFlag = False
+indexFile = ""
+indexFlag = True
+decodeJobs = 1
+numThreads = 0
+pixelType = None
+cacheDir = ""
+cacheSize = 20.0
+manifestFile = ""
 
 isovalue = 300
+isovalues = [300.0]
 CTonly = False
 doubleThreshold = False
 thresholds = []
 tissueType = ""
 shrinkFlag = False
+voxelSize = None
+maxVoxels = None
+isotropicFlag = False
+antialiasFlag = True
+slabSize = 0
+medianRadius = [3, 3, 1]
+surfaceEngine = "auto"
 
 smoothIterations = 5000
 quad = .75
 outname = "results.stl"
 connectivityFilter = True
+numComponents = 1
 anisotropicSmoothing = False
 medianFilter = False
 metadataFile = ""
@@ -80,6 +100,8 @@ WITH_DUPLICATES = True
 def usage():
     print("""
     dicom2stl.py: [options] dicom_directory
+       or
+    dicom2stl.py: [options] --manifest series_manifest.json
     
         -h, --help          This help message
         -v, --verbose       Verbose output
@@ -91,6 +113,13 @@ def usage():
         -c, --clean         Clean up temp files
         -T string, --temp string      Directory to place temporary files
         -s string, --search string    Dicom series search string
+        --index string      Persistent Dicom series index file (default=user cache dir)
+        -j int, --jobs int  Decode Dicom slices with this many workers (default=1)
+        --threads int       Number of threads for the SimpleITK and VTK filters (default=all cores)
+        --pixeltype string  Keep the volume as int16 or float32, rather than float64 for rescaled data
+        --cache string      Cache decoded series in this directory, for repeat runs
+        --cachesize float   Size cap of the series cache in GB (default=20)
+        --manifest string   Convert the series of a dcm_organizer.py series manifest
         -q, --qualityt     Threshold of slices # - to omit low quaility studies (default=160)
         -k, --no-duplicates    If no duplicates (by patientsID) are desired
 
@@ -98,11 +127,17 @@ def usage():
 
         -t string, --type string      CT Tissue type [skin, bone, soft_tissue, fat]
         -a, --anisotropic             Apply anisotropic smoothing to the volume
-        -i num, --isovalue num        Iso-surface value  (default=300)
+        --slab int          Smooth the volume in z-slabs of this many slices (default=0, whole volume)
+        --median string     Apply a median filter with this radius, comma separated (default=3,3,1)
+        -i num, --isovalue num        Iso-surface value, or several seperated by semicolons  (default=300)
         -d string, --double string    Double threshold with 4 values in a string seperated by semicolons
+        --voxelsize float   Resample the volume to this voxel size
+        --maxvoxels int     Resample the volume to at most this many voxels
 
         Mesh options:
 
+        --components int    Keep the int largest objects, picked in the volume before contouring (default=1)
+        --engine string     Isosurface engine [auto, flyingedges, synctemplates, marchingcubes, contour] (default=auto)
         --rotaxis int       Rotation axis (default=1, Y-axis)")
         --rotangle float    Rotation angle (default=180 degrees)")
         --smooth int        Smoothing iterations (default=25)")
@@ -110,18 +145,18 @@ def usage():
 
         Enable/Disable various filtering options")
     
-        --disable string    Disable an option [anisotropic, shrink, median, largest, rotation]")
-        --enable  string    Enable an option [anisotropic, shrink, median, largest, rotation]")
+        --disable string    Disable an option [anisotropic, shrink, median, largest, rotation, index, isotropic, antialias]")
+        --enable  string    Enable an option [anisotropic, shrink, median, largest, rotation, index, isotropic, antialias]")
     """)
 
 # Parse the command line arguments
 #
 
 try:
-    opts, args = getopt.getopt(sys.argv[1:], "vDhacli:s:t:d:o:m:T:q:k:f:",
+    opts, args = getopt.getopt(sys.argv[1:], "vDhacli:s:t:d:o:m:T:q:k:f:j:",
                                ["verbose", "help", "debug", "anisotropic", "clean", "ct", "isovalue=", "search=", "type=",
                                 "double=", "disable=", "enable=", "largest", "metadata", "rotaxis=", "rotangle=", "smooth=",
-                                "reduce=", "temp=", "qualityt=", "no-duplicates", "no-connectfilter"])
+                                "reduce=", "temp=", "qualityt=", "no-duplicates", "no-connectfilter", "index=", "jobs=", "manifest=", "voxelsize=", "maxvoxels=", "slab=", "median=", "threads=", "engine=", "cache=", "cachesize=", "pixeltype=", "components="])
 except getopt.GetoptError as err:
     print(str(err))
     usage()
@@ -142,10 +177,47 @@ for o, a in opts:
         cleanUp = True
     elif o in ("-T", "--temp"):
         tempDir = a
+    elif o == "--index":
+        indexFile = a
+    elif o in ("-j", "--jobs"):
+        decodeJobs = int(a)
+    elif o == "--threads":
+        numThreads = int(a)
+    elif o == "--engine":
+        if a != "auto" and a not in vtkutils.ENGINES:
+            print("Error: unknown isosurface engine.", a)
+            sys.exit(2)
+        surfaceEngine = a
+    elif o == "--pixeltype":
+        if a not in ("int16", "float32"):
+            print("Error: pixel type must be int16 or float32.", a)
+            sys.exit(2)
+        pixelType = a
+    elif o == "--cache":
+        cacheDir = a
+    elif o == "--cachesize":
+        cacheSize = float(a)
+    elif o == "--components":
+        numComponents = int(a)
+        connectivityFilter = True
+    elif o == "--manifest":
+        manifestFile = a
+    elif o == "--voxelsize":
+        voxelSize = float(a)
+    elif o == "--maxvoxels":
+        maxVoxels = int(float(a))
+    elif o == "--slab":
+        slabSize = int(a)
+    elif o == "--median":
+        medianRadius = [int(r) for r in a.split(',')]
+        if len(medianRadius) == 1:
+            medianRadius = medianRadius * 3
+        medianFilter = True
     elif o in ("-a", "--anisotropic"):
         anisotropicSmoothing = True
     elif o in ("-i", "--isovalue"):
-        isovalue = float(a)
+        isovalues = [float(v) for v in a.split(';')]
+        isovalue = isovalues[0]
     elif o in ("--ct"):
         CTonly = True
     elif o in ("-s", "--search"):
@@ -202,17 +274,38 @@ for x in options:
         connectivityFilter = val
     if y.startswith("rotat"):
         rotFlag = val
+    if y.startswith("index"):
+        indexFlag = val
+    if y.startswith("isotrop"):
+        isotropicFlag = val
+    if y.startswith("antialias"):
+        antialiasFlag = val
+
+if numThreads:
+    print("Threads: ", threads.setNumberOfThreads(numThreads))
+
+if not indexFlag:
+    indexFile = None
+elif indexFile == "":
+    indexFile = dicomutils.defaultIndexFile()
 
 # Add '/' to outname if not provided
 outname = outname + '/' if outname[-1] != '/' else outname
 
-# Process all subfolders of given input folder
+# Process all subfolders of given input folder, or all the series
+# of a dcm_organizer.py manifest
 parent_dir = args
-dirs = os.listdir(parent_dir[0])
-sub_dirs = [dir_ for dir_ in dirs if not dir_.startswith('.')]
+if manifestFile:
+    with open(manifestFile, 'r') as infile:
+        manifest = json.load(infile)
+    sub_dirs = sorted(manifest)
+else:
+    dirs = os.listdir(parent_dir[0])
+    sub_dirs = [dir_ for dir_ in dirs if not dir_.startswith('.')]
 counter = 0
 errors = 0
 lowq = 0
+nonct = 0
 duplicate_count = 0
 
 # Setting up Logging
@@ -276,12 +369,16 @@ for sub_dir in sub_dirs:
         logging.info('')
 
         begin_time = datetime.datetime.now()
-        fname = [parent_dir[0] + '/' + sub_dir]
+        if manifestFile:
+            # the series files, wherever they are on disk
+            fname = list(dict.fromkeys(manifest[sub_dir]))
+            dcms = fname
+        else:
+            fname = [parent_dir[0] + '/' + sub_dir]
+            # dcm files identification for loading the Dicom metadata
+            dcms = os.listdir(fname[0])
         outname_subdir = outname + sub_dir + '.stl'
 
-        # dcm files identification for loading pydicom metadata
-        dcms = os.listdir(fname[0])
-
         #print("")
         if tempDir == "":
             tmp_path = os.getcwd() + '/processing_tmps/'
@@ -312,17 +409,20 @@ for sub_dir in sub_dirs:
                 logging.error("Error: Threshold is not of size 4." + str(thresholds))
                 sys.exit(3)
         else:
-            logging.info("Isovalue = " + str(isovalue))
+            logging.info("Isovalue = " + str(isovalues if len(isovalues) > 1 else isovalue))
 
 
         if len(fname) == 0:
             logging.error("Error: no input given.")
             sys.exit(4)
 
-        if zipfile.is_zipfile(fname[0]):
+        if not manifestFile and zipfile.is_zipfile(fname[0]):
             zipFlag = True
 
-        if os.path.isdir(fname[0]):
+        if manifestFile:
+            logging.info("Manifest series: " + sub_dir + ", " + str(len(fname)) + " files")
+
+        elif os.path.isdir(fname[0]):
             dirFlag = True
 
         else:
@@ -341,21 +441,38 @@ for sub_dir in sub_dirs:
         dcmnames = []
         metasrc = img
 
-        #  Load our Dicom data
+        #  Admission: for Dicom directories and manifest series, the CT,
+        #  low quality and duplicate checks are decided from the headers
+        #  alone, so rejected studies never have their pixels decoded.
         #
-        if zipFlag:
-            # Case for a zip file of images
+        series = None
+        if manifestFile:
+            series = dicomutils.fileListSeries(fname)
+            if series is None:
+                raise Exception("no Dicom series found")
+        elif dirFlag and not zipFlag:
             if verbose:
-                print("zip")
-            img, modality = dicomutils.loadZipDicom(fname[0], tempDir)
-
+                logging.info("directory")
+                logging.info(fname[0])
+            series = dicomutils.largestSeries(
+                dicomutils.indexDicomDir(fname[0], indexFile=indexFile))
+            if series is None:
+                raise Exception("no Dicom series found")
+
+        if series is not None:
+            tags = dicomutils.getDicomTags(series[2][0])
+            modality = tags["Modality"]
+            slices_amount = len(series[2])
+            patiendID = tags["PatientID"]
 
         else:
-            if dirFlag:
+            #  Load our Dicom data
+            #
+            if zipFlag:
+                # Case for a zip file of images
                 if verbose:
-                    logging.info("directory")
-                    logging.info(fname[0])
-                img, modality = dicomutils.loadLargestSeries(fname[0])
+                    print("zip")
+                img, modality = dicomutils.loadZipDicom(fname[0], tempDir, pixelType)
 
             else:
                 # Case for a single volume image
@@ -364,6 +481,8 @@ for sub_dir in sub_dirs:
                         print("Reading volume: ", fname[0])
                     img = sitk.ReadImage(fname[0])
                     modality = dicomutils.getModality(img)
+                    if pixelType:
+                        img = dicomutils.compactImage(img, pixelType)
 
                 else:
                     # Case for a series of image files
@@ -377,19 +496,31 @@ for sub_dir in sub_dirs:
                     isr = sitk.ImageSeriesReader()
                     isr.SetFileNames(fname)
                     img = isr.Execute()
-                    firstslice = sitk.ReadImage(fname[0])
-                    modality = dicomutils.getModality(firstslice)
+                    tags = dicomutils.getDicomTags(fname[0]) or {}
+                    modality = tags.get("Modality", "")
+                    if pixelType:
+                        img = dicomutils.compactImage(img, pixelType)
+
+            slices_amount = img.GetSize()[2]
+            single_dcm = fname[0] + '/' + dcms[0]
+            patiendID = dicomutils.getDicomTags(single_dcm)["PatientID"]
 
         if CTonly and ((sitk.Version.MinorVersion() > 8) or (sitk.Version.MajorVersion() > 0)):
             # Check the metadata for CT image type.  Note that this only works with
             # SimpleITK version 0.8.0 or later.  For earlier versions there is no GetMetaDataKeys method
 
             if modality.find("CT") == -1:
-                logging.error("Imaging modality is not CT.  Exiting.")
-                sys.exit(1)
+                nonct += 1
+                logging.error("Imaging modality is not CT, ommiting conversion.")
+                logging.info('')
+                logging.info(str("##### Progress %:  {0:.0%}".format(counter/len(sub_dirs))))
+                logging.info('')
+                shutil.rmtree(tempDir)
+                tempDir = ""
+                print('')
+                continue
 
         # Loq quality verification:
-        slices_amount = img.GetSize()[2]
         if slices_amount < LOWQUALITY_SLICES_TH:
             lowq += 1
             logging.warning('The Series only contains: ' + str(slices_amount) + ' slices')
@@ -403,9 +534,6 @@ for sub_dir in sub_dirs:
             continue
 
         # Duplicates verification
-        single_dcm = fname[0] + '/' + dcms[0]
-        pydicom_meta = pydicom.dcmread(single_dcm)
-        patiendID = pydicom_meta.PatientID
         patiendID = patiendID.replace('/', '-')
         if WITH_DUPLICATES: 
             patientID_duplicate_count = len([x for x in patientsID_log if patiendID == x]) # check how many entries for this patientID are there in the log
@@ -431,6 +559,14 @@ for sub_dir in sub_dirs:
             else:
                 patientsID_log.append(patiendID)
 
+        # Only admitted studies get decoded
+        if series is not None:
+            if cacheDir:
+                img, modality = volumecache.loadSeriesSetCached(
+                    series, cacheDir, int(cacheSize * 1024**3), decodeJobs, pixelType)
+            else:
+                img, modality = dicomutils.loadSeriesSet(series, decodeJobs, pixelType)
+
 
         #vtkname =  tempDir+"/vol0.vtk"
         #sitk.WriteImage( img, vtkname )
@@ -441,7 +577,7 @@ for sub_dir in sub_dirs:
 
 
         def elapsedTime(start_time):
-            dt = roundThousand(time.clock()-start_time)
+            dt = roundThousand(time.perf_counter()-start_time)
             print("    ", dt, "seconds")
 
 
@@ -461,8 +597,12 @@ for sub_dir in sub_dirs:
 
 
         #
-        # shrink the volume to 256 cubed
-        if shrinkFlag:
+        # resample the volume to the requested voxel size or voxel budget,
+        # otherwise shrink the volume to 256 cubed
+        if voxelSize or maxVoxels or isotropicFlag:
+            img = sitkutils.resampleVolume(img, voxelSize, maxVoxels, isotropicFlag, antialiasFlag)
+
+        elif shrinkFlag:
             sfactor = []
             size = img.GetSize()
             sum = 0
@@ -473,7 +613,7 @@ for sub_dir in sub_dirs:
 
             if sum > 3:
                 # if sum==3, no shrink happens
-                t = time.clock()
+                t = time.perf_counter()
                 print("Shrink factors: ", sfactor)
                 img = sitk.Shrink(img, sfactor)
                 newsize = img.GetSize()
@@ -488,39 +628,51 @@ for sub_dir in sub_dirs:
         #
         if anisotropicSmoothing:
             print("Anisotropic Smoothing")
-            t = time.clock()
-            pixelType = img.GetPixelID()
-            img = sitk.Cast(img, sitk.sitkFloat32)
-            img = sitk.CurvatureAnisotropicDiffusion(img, .03)
-            img = sitk.Cast(img, pixelType)
-            elapsedTime(t)
+            img = sitkutils.anisotropicDiffusion(img, .03, slab=slabSize)
             gc.collect()
 
-        # Apply the double threshold filter to the volume
+        # Apply the double threshold filter, the median filter and the padding
+        # to the volume.  The median votes straight into the padded uint8 output
         #
         if doubleThreshold:
-            print("Double Threshold")
-            t = time.clock()
-            img = sitk.DoubleThreshold(
-                img, thresholds[0], thresholds[1], thresholds[2], thresholds[3], 255, 0)
-            isovalue = 64.0
-            elapsedTime(t)
+            print("Double Threshold" + (" + Median filter" if medianFilter else "") + " + Pad")
+            img = sitkutils.thresholdMedianPad(img, thresholds,
+                                               medianRadius if medianFilter else None, 5)
+            isovalues = [64.0]
             gc.collect()
 
-        # Apply a 3x3x1 median filter.  I only use 1 in the Z direction so it's not so slow.
+        else:
+            # Apply a median filter, 3x3x1 by default.  A binary volume gets the
+            # much cheaper majority vote, which gives the same result.
+            #
+            if medianFilter:
+                print("Median filter", medianRadius)
+                binary = sitkutils.isBinary(img)
+                if binary is not None:
+                    img = sitkutils.majorityFilter(img, medianRadius, binary)
+                else:
+                    t = time.perf_counter()
+                    img = sitk.Median(img, medianRadius)
+                    elapsedTime(t)
+                gc.collect()
+
+        # Drop the smaller objects in the volume, so the table, headrest and
+        # stray artifacts are never contoured.  The mesh connectivity filter
+        # still runs, on the much smaller mesh, since one object can hold
+        # several surfaces, such as closed cavities.  The regions differ
+        # with the isovalue, so several isovalues are left to the mesh
+        # filter alone.
         #
-        if medianFilter:
-            print("Median filter")
-            t = time.clock()
-            img = sitk.Median(img, [3, 3, 1])
-            elapsedTime(t)
+        if connectivityFilter and len(isovalues) == 1:
+            img = sitkutils.keepLargestComponents(img, isovalues[0], count=numComponents)
             gc.collect()
 
-        # Pad black to the boundaries of the image
-        #
-        pad = [5, 5, 5]
-        img = sitk.ConstantPad(img, pad, pad)
-        gc.collect()
+        if not doubleThreshold:
+            # Pad black to the boundaries of the image
+            #
+            pad = [5, 5, 5]
+            img = sitk.ConstantPad(img, pad, pad)
+            gc.collect()
 
         if verbose:
             logging.info("Image for isocontouring")
@@ -556,29 +708,10 @@ for sub_dir in sub_dirs:
 
         if debug:
             print("Extracting surface")
-        mesh = vtkutils.extractSurface(vtkimg, isovalue)
+        # the surfaces for several isovalues are contoured concurrently
+        meshes = vtkutils.extractSurface(vtkimg, isovalues, surfaceEngine)
         vtkimg = None
         gc.collect()
-        if debug:
-            print("Cleaning mesh")
-        mesh2 = vtkutils.cleanMesh(mesh, connectivityFilter)
-        mesh = None
-        gc.collect()
-        if debug:
-            print("Smoothing mesh", smoothIterations, "iterations")
-        mesh3 = vtkutils.smoothMesh(mesh2, smoothIterations)
-        mesh2 = None
-        gc.collect()
-        if debug:
-            print("Simplifying mesh")
-        mesh4 = vtkutils.reduceMesh(mesh3, quad)
-        mesh3 = None
-        gc.collect()
-
-        if rotFlag:
-            mesh5 = vtkutils.rotateMesh(mesh4, rotAxis, rotAngle)
-        else:
-            mesh5 = mesh4
 
         # Outdir verification
         if outname[0] == '/':
@@ -587,10 +720,40 @@ for sub_dir in sub_dirs:
         else:
             if not os.path.exists(os.getcwd() + '/' + outname):
                 os.makedirs(os.getcwd() + '/' + outname)
-        
-        vtkutils.writeMesh(mesh5, outname_subdir)
-        mesh4 = None
-        gc.collect()
+
+        saved = []
+        for value, mesh in zip(isovalues, meshes):
+            if debug:
+                print("Cleaning mesh")
+            mesh2 = vtkutils.cleanMesh(mesh, numComponents if connectivityFilter else False)
+            mesh = None
+            gc.collect()
+            if debug:
+                print("Smoothing mesh", smoothIterations, "iterations")
+            mesh3 = vtkutils.smoothMesh(mesh2, smoothIterations)
+            mesh2 = None
+            gc.collect()
+            if debug:
+                print("Simplifying mesh")
+            mesh4 = vtkutils.reduceMesh(mesh3, quad)
+            mesh3 = None
+            gc.collect()
+
+            if rotFlag:
+                mesh5 = vtkutils.rotateMesh(mesh4, rotAxis, rotAngle)
+            else:
+                mesh5 = mesh4
+
+            # one file per isovalue, patient_150.stl, when there are several
+            meshname = outname_subdir
+            if len(isovalues) > 1:
+                meshname = outname_subdir[:-4] + '_' + ('%g' % value) + '.stl'
+            vtkutils.writeMesh(mesh5, meshname)
+            saved.append(meshname)
+            mesh4 = None
+            gc.collect()
+        meshes = None
+        outname_subdir = ', '.join(saved)
 
 
         # remove the temp directory
@@ -614,14 +777,21 @@ for sub_dir in sub_dirs:
         #logf.close()
         continue
 
+    finally:
+        # the headers of a study are not needed again, don't let them
+        # pile up over the whole batch
+        dicomutils.clearDicomHeaderCache()
+
 # Save patientsID Log
 with open(patientsID_log_fname, 'w') as infile:
     json.dump(list(patientsID_log), infile)
 
 logging.info('################################################')
 logging.info('BATCH PROCESSING COMPLETED')
-logging.info(str(counter - errors - lowq - duplicate_count) + ' SCANS PROCESSED')
+logging.info(str(counter - errors - lowq - nonct - duplicate_count) + ' SCANS PROCESSED')
 logging.info(str(lowq) + ' SCANS OMMITED DUE TO LOW QUALITY')
+if CTonly:
+    logging.info(str(nonct) + ' NON CT SCANS OMMITED')
 if not WITH_DUPLICATES: 
     logging.info(str(duplicate_count) + ' DUPLICATE PATIENT SCANS OMMITED')
 logging.info(str(errors) + ' ERRORS FOUND' )
@@ -0,0 +1,101 @@
+#! /usr/bin/env python
+
+"""
+Time and memory benchmark of sitk2vtk, shared buffer versus deep copy,
+and of vtk2sitk, for the pixel types megatest.py sees.
+
+Usage: bench_sitk2vtk.py [size] [image files or directories]
+"""
+
+import sys, os, time, gc, glob
+import SimpleITK as sitk
+
+import compare_stats
+thisdir = os.path.dirname(os.path.abspath(__file__))
+parentdir = os.path.dirname(thisdir)
+sys.path.append(os.path.abspath(parentdir))
+from utils import sitk2vtk
+from utils import vtk2sitk
+
+pixelTypes = [sitk.sitkUInt8, sitk.sitkInt8, sitk.sitkUInt16, sitk.sitkInt16,
+              sitk.sitkUInt32, sitk.sitkInt32, sitk.sitkFloat32, sitk.sitkFloat64]
+
+
+def residentMemory():
+    """Current resident memory of the process in bytes (Linux)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except:
+        return 0
+
+
+def mb(x):
+    return "%8.1f" % (x / (1024.0*1024.0))
+
+
+def bench(img, label):
+    results = [label, img.GetPixelIDTypeAsString()]
+    vtkimg = None
+    for deep in (True, False):
+        vtkimg = None
+        gc.collect()
+        m0 = residentMemory()
+        t = time.perf_counter()
+        vtkimg = sitk2vtk.sitk2vtk(img, deepCopy=deep)
+        dt = time.perf_counter() - t
+        dm = residentMemory() - m0
+        if img.GetNumberOfComponentsPerPixel() == 1:
+            if not compare_stats.compare_stats(img, vtkimg):
+                print("FAIL", label)
+        results.extend([dt, dm])
+
+    img2 = None
+    gc.collect()
+    m0 = residentMemory()
+    t = time.perf_counter()
+    img2 = vtk2sitk.vtk2sitk(vtkimg)
+    dt = time.perf_counter() - t
+    dm = residentMemory() - m0
+    results.extend([dt, dm])
+    vtkimg = img2 = None
+    gc.collect()
+    return results
+
+
+size = 256
+fnames = []
+for x in sys.argv[1:]:
+    if x.isdigit():
+        size = int(x)
+    elif os.path.isfile(x):
+        fnames.append(x)
+    elif os.path.isdir(x):
+        fnames.extend(glob.glob(x+'/*'))
+
+rows = []
+for ptype in pixelTypes:
+    # integer values, so the VTK histogram statistics are exact
+    img = sitk.GaussianSource(sitk.sitkUInt8, [size]*3, sigma=[size/4.0]*3,
+                              mean=[size/2.0]*3, scale=100)
+    img = sitk.Cast(img, ptype)
+    rows.append(bench(img, "gaussian " + str(size)))
+    img = None
+
+rgb = sitk.Compose([sitk.GaussianSource(sitk.sitkUInt8, [size]*3)]*3)
+rows.append(bench(rgb, "rgb " + str(size)))
+rgb = None
+
+for n in fnames:
+    try:
+        img = sitk.ReadImage(n)
+        rows.append(bench(img, os.path.basename(n)))
+    except:
+        print("File", n, "didn't convert")
+
+print("")
+print("%-20s %-28s %9s %8s %9s %8s %9s %8s" % ("image", "pixel type", "copy s", "copy MB",
+                                                "share s", "share MB", "back s", "back MB"))
+for r in rows:
+    print("%-20s %-28s %9.4f %s %9.4f %s %9.4f %s" % (r[0], r[1], r[2], mb(r[3]),
+                                                       r[4], mb(r[5]), r[6], mb(r[7])))
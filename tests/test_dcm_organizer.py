@@ -0,0 +1,203 @@
+#! /usr/bin/env python
+
+import unittest
+import os, errno, shutil, json, tempfile
+from unittest import mock
+import SimpleITK as sitk
+
+import dcm_organizer
+from utils import dicomutils
+
+
+def write_dcm(fname, uid, modality="CT", bodypart="HEAD"):
+    # a tiny Dicom slice with just the tags the organizer reads
+    img = sitk.Image(4, 4, sitk.sitkInt16)
+    img.SetMetaData("0008|0060", modality)
+    img.SetMetaData("0018|0015", bodypart)
+    img.SetMetaData("0020|000e", uid)
+    writer = sitk.ImageFileWriter()
+    writer.KeepOriginalImageUIDOn()
+    writer.SetFileName(fname)
+    writer.Execute(img)
+
+
+class TestDcmOrganizer(unittest.TestCase):
+
+    UIDS = ["1.2.826.0.1.3680043.2.1125.1", "1.2.826.0.1.3680043.2.1125.2"]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.src = self.tmpdir + "/src/"
+        self.out = self.tmpdir + "/out/"
+        os.mkdir(self.src)
+        self.db = self.tmpdir + "/organized_dcms.db"
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_files(self, names, uid=None):
+        for i, name in enumerate(names):
+            write_dcm(self.src + name, uid or TestDcmOrganizer.UIDS[i % 2])
+
+    def test_processedLogFresh(self):
+        print("\nTesting dcm_organizer processed log on a fresh database")
+        log = dcm_organizer.open_processed_log(self.db)
+        self.assertFalse(dcm_organizer.is_processed(log, "a.dcm"))
+        dcm_organizer.mark_processed(log, ["a.dcm", "b.dcm", "a.dcm"])
+        self.assertTrue(dcm_organizer.is_processed(log, "a.dcm"))
+        self.assertFalse(dcm_organizer.is_processed(log, "c.dcm"))
+        log.close()
+
+        # the log survives a reopen
+        log = dcm_organizer.open_processed_log(self.db)
+        self.assertTrue(dcm_organizer.is_processed(log, "b.dcm"))
+        self.assertEqual(log.execute("SELECT COUNT(*) FROM processed").fetchone()[0], 2)
+        log.close()
+
+    def test_processedLogImport(self):
+        print("\nTesting dcm_organizer import of the old JSON log")
+        old = self.tmpdir + "/organized_dcms.log"
+        with open(old, "w") as f:
+            json.dump(["a.dcm", "b.dcm"], f)
+        log = dcm_organizer.open_processed_log(self.db, old)
+        self.assertTrue(dcm_organizer.is_processed(log, "a.dcm"))
+        self.assertTrue(dcm_organizer.is_processed(log, "b.dcm"))
+        log.close()
+
+        # the import only happens when the database is created
+        with open(old, "w") as f:
+            json.dump(["c.dcm"], f)
+        log = dcm_organizer.open_processed_log(self.db, old)
+        self.assertFalse(dcm_organizer.is_processed(log, "c.dcm"))
+        log.close()
+
+        # a broken old log doesn't stop a new database
+        os.remove(self.db)
+        with open(old, "w") as f:
+            f.write("[not json")
+        log = dcm_organizer.open_processed_log(self.db, old)
+        self.assertFalse(dcm_organizer.is_processed(log, "a.dcm"))
+        log.close()
+
+    def test_rerunSkipsProcessed(self):
+        print("\nTesting dcm_organizer skips processed files on a rerun")
+        names = ["%d.dcm" % i for i in range(4)]
+        self.make_files(names)
+        log = dcm_organizer.open_processed_log(self.db)
+        done, counter, errors, total, uids = dcm_organizer.organizer(
+            self.src, self.out, "CT", "HEAD", self.db, log)
+        dcm_organizer.mark_processed(log, done)
+        self.assertEqual(sorted(done), names)
+        self.assertEqual((counter, errors, total, uids), (4, 0, 4, 2))
+
+        # the same files show up again, plus a new one
+        self.make_files(names + ["new.dcm"])
+        done, counter, errors, total, uids = dcm_organizer.organizer(
+            self.src, self.out, "CT", "HEAD", self.db, log)
+        self.assertEqual(done, ["new.dcm"])
+        self.assertEqual((counter, total), (1, 5))
+        self.assertTrue(os.path.exists(self.out + TestDcmOrganizer.UIDS[0] + "/new.dcm"))
+        log.close()
+
+    def organize(self, mode, manifest=None):
+        log = dcm_organizer.open_processed_log(self.db)
+        result = dcm_organizer.organizer(self.src, self.out, "CT", "HEAD", self.db, log,
+                                         mode, manifest)
+        log.close()
+        return result
+
+    def test_outputModes(self):
+        print("\nTesting dcm_organizer output modes")
+        names = ["%d.dcm" % i for i in range(4)]
+        for mode in dcm_organizer.OUTPUT_MODES:
+            shutil.rmtree(self.src)
+            shutil.rmtree(self.out, ignore_errors=True)
+            os.mkdir(self.src)
+            if os.path.exists(self.db):
+                os.remove(self.db)
+            self.make_files(names)
+            # a file of another body part is left alone
+            write_dcm(self.src + "chest.dcm", TestDcmOrganizer.UIDS[0], bodypart="CHEST")
+
+            manifest = {} if mode == "manifest" else None
+            done, counter, errors, total, uids = self.organize(mode, manifest)
+            self.assertEqual((counter, errors, total, uids), (4, 0, 5, 2), mode)
+
+            if mode == "manifest":
+                self.assertFalse(os.path.exists(self.out))
+                dcm_organizer.save_manifest(self.out, manifest)
+                self.assertEqual(os.listdir(self.out), [dcm_organizer.MANIFEST_FNAME])
+                self.assertEqual(dcm_organizer.load_manifest(self.out), manifest)
+                # each entry is what dicom2stl_tuned.py --manifest loads
+                for uid in TestDcmOrganizer.UIDS:
+                    files = manifest[uid]
+                    self.assertEqual(len(files), 2)
+                    self.assertTrue(all(os.path.isabs(f) and os.path.exists(f) for f in files))
+                    self.assertEqual(dicomutils.fileListSeries(files)[0], uid)
+                continue
+
+            for i, name in enumerate(names):
+                src = self.src + name
+                out = self.out + TestDcmOrganizer.UIDS[i % 2] + "/" + name
+                self.assertTrue(os.path.isfile(out), mode)
+                if mode == "move":
+                    self.assertFalse(os.path.exists(src))
+                elif mode == "hardlink":
+                    self.assertFalse(os.path.islink(out))
+                    self.assertTrue(os.path.samefile(src, out))
+                elif mode == "symlink":
+                    self.assertEqual(os.readlink(out), os.path.abspath(src))
+            self.assertTrue(os.path.exists(self.src + "chest.dcm"))
+
+    def test_hardlinkFallback(self):
+        print("\nTesting dcm_organizer hard link fallback")
+        self.make_files(["0.dcm"])
+        os.mkdir(self.out)
+        cross = OSError(errno.EXDEV, "Invalid cross-device link")
+        with mock.patch("os.link", side_effect=cross):
+            with self.assertLogs(level="WARNING") as logs:
+                dcm_organizer.place_file(self.src + "0.dcm", self.out + "0.dcm", "hardlink")
+        self.assertIn("making a symlink instead", logs.output[0])
+        self.assertEqual(os.readlink(self.out + "0.dcm"), os.path.abspath(self.src + "0.dcm"))
+
+    def layout(self):
+        return sorted(os.path.relpath(os.path.join(d, f), self.out)
+                      for d, dirs, files in os.walk(self.out) for f in files)
+
+    def test_organizerParallel(self):
+        print("\nTesting dcm_organizer.organizer_parallel against organizer")
+        names = ["%d.dcm" % i for i in range(12)]
+        for mode in dcm_organizer.OUTPUT_MODES:
+            results = []
+            for jobs in (1, 3):
+                shutil.rmtree(self.src)
+                shutil.rmtree(self.out, ignore_errors=True)
+                os.mkdir(self.src)
+                if os.path.exists(self.db):
+                    os.remove(self.db)
+                self.make_files(names)
+                write_dcm(self.src + "chest.dcm", TestDcmOrganizer.UIDS[0], bodypart="CHEST")
+                with open(self.src + "notes.txt", "w") as f:
+                    f.write("not a Dicom file\n")
+
+                manifest = {} if mode == "manifest" else None
+                log = dcm_organizer.open_processed_log(self.db)
+                if jobs == 1:
+                    result = dcm_organizer.organizer(self.src, self.out, "CT", "HEAD",
+                                                     self.db, log, mode, manifest)
+                else:
+                    result = dcm_organizer.organizer_parallel(self.src, self.out, "CT", "HEAD",
+                                                              self.db, log, jobs, mode, manifest)
+                log.close()
+                done, counter, errors, total, uids = result
+                if manifest is not None:
+                    manifest = {uid: sorted(files) for uid, files in manifest.items()}
+                results.append((sorted(done), counter, errors, total, uids,
+                                self.layout(), sorted(os.listdir(self.src)), manifest))
+
+            self.assertEqual(results[0], results[1], mode)
+            self.assertEqual(results[0][1:5], (12, 1, 14, 2), mode)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+#! /usr/bin/env python
+
+import unittest
+import os, sys, shutil, subprocess, tempfile
+import numpy as np
+import SimpleITK as sitk
+import vtk
+
+
+class TestDicom2STL(unittest.TestCase):
+
+    SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                          "dicom2stl.py")
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_script(self, *args):
+        result = subprocess.run([sys.executable, TestDicom2STL.SCRIPT, "--disable", "index"] +
+                                list(args), cwd=self.tmpdir, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, universal_newlines=True)
+        print(result.stdout)
+        self.assertEqual(result.returncode, 0)
+        return result.stdout
+
+    def read_mesh(self, fname):
+        reader = vtk.vtkSTLReader()
+        reader.SetFileName(os.path.join(self.tmpdir, fname))
+        reader.Update()
+        return reader.GetOutput()
+
+    def assertSameMesh(self, a, b):
+        self.assertGreater(a.GetNumberOfPolys(), 0)
+        self.assertEqual(a.GetNumberOfPoints(), b.GetNumberOfPoints())
+        self.assertEqual(a.GetNumberOfPolys(), b.GetNumberOfPolys())
+        for x, y in zip(a.GetBounds(), b.GetBounds()):
+            self.assertAlmostEqual(x, y, 3)
+
+    def noisy_ball(self):
+        # a noisy ball in one corner of a mostly empty volume
+        img = sitk.GaussianSource(sitk.sitkFloat32, [64, 64, 48], sigma=[6, 6, 6],
+                                  mean=[16, 18, 14], scale=1000)
+        img = sitk.AdditiveGaussianNoise(img, 60, 0, 3)
+        img = sitk.Cast(img, sitk.sitkInt16)
+        img.SetSpacing([0.8, 0.8, 1.5])
+        fname = os.path.join(self.tmpdir, "ball.nrrd")
+        sitk.WriteImage(img, fname)
+        return fname
+
+    def test_cropKeepsSurface(self):
+        print("\nTesting dicom2stl.py gives the same surface with and without the crop")
+        ball = self.noisy_ball()
+        # smoothing, which is cropped after, and a median, cropped before
+        for options in (["-a", "--enable", "median", "-i", "300"],
+                        ["--median", "2,2,2", "-i", "300"]):
+            out = self.run_script(*(options + ["-o", "cropped.stl", ball]))
+            self.assertIn("Auto crop", out)
+            self.run_script(*(options + ["--disable", "crop", "-o", "full.stl", ball]))
+            self.assertSameMesh(self.read_mesh("cropped.stl"), self.read_mesh("full.stl"))
+
+    def test_multiTissue(self):
+        print("\nTesting dicom2stl.py meshes several tissues in one run")
+        ball = self.noisy_ball()
+        sets = ["100;300;2000;3000", "400;600;2000;3000"]
+        out = self.run_script("--enable", "median", "-d", sets[0], "-d", sets[1],
+                              "-o", "result.stl", ball)
+        self.assertIn("Extracting 2 tissues with", out)
+        # each tissue gives the same mesh as a run with just its thresholds
+        for i, thresholds in enumerate(sets):
+            self.run_script("--enable", "median", "-d", thresholds, "-o", "single.stl", ball)
+            self.assertSameMesh(self.read_mesh("result_double%d.stl" % (i+1)),
+                                self.read_mesh("single.stl"))
+
+
+if __name__ == "__main__":
+    unittest.main()
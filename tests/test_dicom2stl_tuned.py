@@ -0,0 +1,46 @@
+#! /usr/bin/env python
+
+import unittest
+import os, sys, shutil, json, subprocess, tempfile
+
+
+class TestDicom2STLTuned(unittest.TestCase):
+
+    SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                          "dicom2stl_tuned.py")
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_manifestWithoutDicom(self):
+        print("\nTesting dicom2stl_tuned.py with a manifest of non-Dicom files")
+        files = []
+        for i in range(3):
+            name = os.path.join(self.tmpdir, "notes" + str(i) + ".txt")
+            with open(name, "w") as f:
+                f.write("not a Dicom file\n")
+            files.append(name)
+        manifest = os.path.join(self.tmpdir, "series_manifest.json")
+        with open(manifest, "w") as f:
+            json.dump({"study1": files}, f)
+        outdir = os.path.join(self.tmpdir, "out")
+        os.mkdir(outdir)
+
+        # the script writes its logs into the working directory
+        result = subprocess.run([sys.executable, TestDicom2STLTuned.SCRIPT,
+                                  "--disable", "index", "--manifest", manifest,
+                                  "-o", outdir],
+                                 cwd=self.tmpdir, stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT, universal_newlines=True)
+        print(result.stdout)
+        self.assertEqual(result.returncode, 0)
+        self.assertIn("no Dicom series found", result.stdout)
+        self.assertIn("1 ERRORS FOUND", result.stdout)
+        self.assertEqual(os.listdir(outdir), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
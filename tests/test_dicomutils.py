@@ -3,6 +3,7 @@
 import unittest
 import os, shutil, zipfile
 import vtk
+import numpy as np
 import SimpleITK as sitk
 
 from utils import dicomutils
@@ -46,6 +47,74 @@ class TestDicomUtils(unittest.TestCase):
         else:
            self.fail("    Bad series: "+series_id)
 
+    def test_indexDicomDir(self):
+        print("\nTesting DicomUtils.indexDicomDir")
+        seriessets = dicomutils.indexDicomDir(TestDicomUtils.TMPDIR)
+        gdcmsets = dicomutils.getAllSeries([TestDicomUtils.TMPDIR])
+        self.assertEqual(len(seriessets), 1)
+        self.assertEqual(seriessets[0][0], gdcmsets[0][0])
+        self.assertEqual(list(seriessets[0][2]), list(gdcmsets[0][2]))
+
+    def test_seriesIndex(self):
+        print("\nTesting DicomUtils.indexDicomDir with a persistent index")
+        indexFile = "tests/series_index.sqlite"
+        try:
+            first = dicomutils.indexDicomDir(TestDicomUtils.TMPDIR, indexFile=indexFile)
+            second = dicomutils.indexDicomDir(TestDicomUtils.TMPDIR, indexFile=indexFile)
+            self.assertEqual(first, second)
+            self.assertEqual(len(second[0][2]), TestDicomUtils.SIZE)
+            conn = dicomutils.openSeriesIndex(indexFile)
+            count = conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+            conn.close()
+            self.assertEqual(count, TestDicomUtils.SIZE)
+        finally:
+            os.unlink(indexFile)
+
+    def test_readDicomHeader(self):
+        print("\nTesting DicomUtils.readDicomHeader")
+        header = dicomutils.readDicomHeader(TestDicomUtils.TMPDIR+'/0.dcm')
+        self.assertEqual(header["Modality"], "CT")
+        self.assertEqual(len(header["ImagePositionPatient"]), 3)
+        self.assertIsNone(dicomutils.readDicomHeader(__file__))
+
+    def test_preamblelessFiles(self):
+        print("\nTesting DicomUtils.indexDicomDir on files without a preamble")
+        import struct
+        rawdir = "tests/rawtmp"
+        os.mkdir(rawdir)
+        try:
+            for name in os.listdir(TestDicomUtils.TMPDIR):
+                with open(TestDicomUtils.TMPDIR + "/" + name, "rb") as f:
+                    data = f.read()
+                self.assertEqual(data[128:132], b"DICM")
+                # drop the preamble, the marker and the group 2 file meta,
+                # whose (0002,0000) group length is the first element
+                metaLength = struct.unpack("<I", data[140:144])[0]
+                with open(rawdir + "/" + name, "wb") as f:
+                    f.write(data[144 + metaLength:])
+
+            self.assertIsNotNone(dicomutils.readDicomHeader(rawdir + "/0.dcm"))
+            gdcmsets = dicomutils.getAllSeries([rawdir])
+            seriessets = dicomutils.indexDicomDir(rawdir)
+            self.assertEqual(len(seriessets), 1)
+            self.assertEqual(len(seriessets[0][2]), TestDicomUtils.SIZE)
+            self.assertEqual(seriessets[0][0], gdcmsets[0][0])
+
+            img, mod = dicomutils.loadLargestSeries(rawdir)
+            ref, refmod = dicomutils.loadLargestSeries(TestDicomUtils.TMPDIR)
+            self.assertEqual(mod, "CT")
+            self.assertEqual(abs(sitk.GetArrayFromImage(img - ref)).max(), 0)
+        finally:
+            shutil.rmtree(rawdir)
+
+    def test_getDicomTags(self):
+        print("\nTesting DicomUtils.getDicomTags")
+        fname = TestDicomUtils.TMPDIR+'/1.dcm'
+        tags = dicomutils.getDicomTags(fname)
+        self.assertEqual(tags["Modality"], "CT")
+        self.assertIs(dicomutils.getDicomTags(fname), tags)
+        self.assertIsNone(dicomutils.getDicomTags(__file__))
+
     def test_getModality(self):
         print("\nTesting DicomUtils.getModality")
         img = sitk.Image(10,10,sitk.sitkUInt16)
@@ -61,6 +130,123 @@ class TestDicomUtils(unittest.TestCase):
         self.assertEqual(img.GetSize(), (TestDicomUtils.SIZE,TestDicomUtils.SIZE,TestDicomUtils.SIZE))
         self.assertEqual(mod, "CT")
 
+    def test_loadFileListSeries(self):
+        print("\nTesting DicomUtils.loadFileListSeries")
+        files = [TestDicomUtils.TMPDIR+'/'+str(z)+'.dcm' for z in range(TestDicomUtils.SIZE)]
+        files.reverse()
+        img, mod = dicomutils.loadFileListSeries(files)
+        ref, refmod = dicomutils.loadLargestSeries(TestDicomUtils.TMPDIR)
+        self.assertEqual(mod, "CT")
+        self.assertEqual(img.GetOrigin(), ref.GetOrigin())
+        self.assertEqual(abs(sitk.GetArrayFromImage(img - ref)).max(), 0)
+
+    def test_loadSeriesParallel(self):
+        print("\nTesting DicomUtils.loadSeriesParallel")
+        ref, mod = dicomutils.loadLargestSeries(TestDicomUtils.TMPDIR)
+        files = dicomutils.indexDicomDir(TestDicomUtils.TMPDIR)[0][2]
+        img = dicomutils.loadSeriesParallel(files, nworkers=4)
+        self.assertEqual(img.GetSize(), ref.GetSize())
+        self.assertEqual(img.GetPixelID(), ref.GetPixelID())
+        self.assertEqual(img.GetOrigin(), ref.GetOrigin())
+        self.assertEqual(img.GetSpacing(), ref.GetSpacing())
+        self.assertEqual(abs(sitk.GetArrayFromImage(img - ref)).max(), 0)
+
+        # chunks smaller than the series, decoded by threads and processes
+        for useProcesses in (False, True):
+            img = dicomutils.loadSeriesParallel(files, nworkers=2, chunk=3,
+                                                useProcesses=useProcesses)
+            self.assertEqual(img.GetOrigin(), ref.GetOrigin())
+            self.assertEqual(abs(sitk.GetArrayFromImage(img - ref)).max(), 0)
+
+    def test_seriesSlabReader(self):
+        print("\nTesting DicomUtils.seriesSlabReader")
+        ref, mod = dicomutils.loadLargestSeries(TestDicomUtils.TMPDIR)
+        ss = dicomutils.indexDicomDir(TestDicomUtils.TMPDIR)[0]
+        readSlab, dims, origin, spacing = dicomutils.seriesSlabReader(ss, nworkers=2)
+        self.assertEqual(tuple(dims), ref.GetSize())
+        self.assertEqual(tuple(origin), ref.GetOrigin())
+        self.assertEqual(tuple(spacing), ref.GetSpacing())
+        slab = readSlab(5, 12)
+        self.assertEqual(slab.shape, (7, TestDicomUtils.SIZE, TestDicomUtils.SIZE))
+        self.assertEqual(abs(slab - sitk.GetArrayViewFromImage(ref)[5:12]).max(), 0)
+
+    def test_compactPixelType(self):
+        print("\nTesting DicomUtils.loadSeriesParallel with a compact pixel type")
+        tmpdir = "tests/floattmp"
+        cyl = create_data.make_cylinder(TestDicomUtils.SIZE, sitk.sitkFloat64)
+        cyl = cyl * 10.5 - 3.25
+        try:
+            os.mkdir(tmpdir)
+            write_series.write_series(cyl, tmpdir, np.float64)
+            files = dicomutils.fileListSeries(
+                [tmpdir + "/" + f for f in os.listdir(tmpdir)])[2]
+            full = dicomutils.loadSeriesParallel(files, nworkers=2)
+            self.assertEqual(full.GetPixelID(), sitk.sitkFloat64)
+            fullarr = sitk.GetArrayFromImage(full)
+
+            img = dicomutils.loadSeriesParallel(files, nworkers=2, pixelType="int16")
+            self.assertEqual(img.GetPixelID(), sitk.sitkInt16)
+            self.assertEqual(img.GetOrigin(), full.GetOrigin())
+            self.assertLessEqual(np.abs(sitk.GetArrayViewFromImage(img) - fullarr).max(), 0.5)
+
+            img, modality = dicomutils.loadFileListSeries(files, 1, pixelType="float32")
+            self.assertEqual(img.GetPixelID(), sitk.sitkFloat32)
+            self.assertLess(np.abs(sitk.GetArrayViewFromImage(img) - fullarr).max(), 1e-3)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_compactPixelTypeSameSize(self):
+        print("\nTesting DicomUtils.compactDtype keeps types of the target size")
+        self.assertEqual(dicomutils.compactDtype(np.uint16, "int16"), np.uint16)
+        self.assertEqual(dicomutils.compactDtype(np.int32, "float32"), np.int32)
+        self.assertEqual(dicomutils.compactDtype(np.int32, "int16"), np.int16)
+        self.assertEqual(dicomutils.compactDtype(np.float64, "float32"), np.float32)
+        self.assertEqual(dicomutils.compactDtype(np.uint8, "int16"), np.uint8)
+
+        # a uint16 series with values above the int16 range is loaded as is
+        tmpdir = "tests/uint16tmp"
+        cyl = create_data.make_cylinder(TestDicomUtils.SIZE, sitk.sitkUInt16)
+        cyl[5, 5, 5] = 40000
+        try:
+            os.mkdir(tmpdir)
+            write_series.write_series(cyl, tmpdir)
+            files = dicomutils.fileListSeries(
+                [tmpdir + "/" + f for f in os.listdir(tmpdir)])[2]
+            img = dicomutils.loadSeriesParallel(files, nworkers=2, pixelType="int16")
+            self.assertEqual(img.GetPixelID(), sitk.sitkUInt16)
+            self.assertEqual(img[5, 5, 5], 40000)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_streamSeries(self):
+        print("\nTesting DicomUtils.streamSeries")
+        mrdir = "tests/mrtmp"
+        os.mkdir(mrdir)
+        try:
+            for n, uid in enumerate(["1.2.3.1", "1.2.3.2", "1.2.3.3"]):
+                seriesdir = mrdir + "/" + str(n)
+                os.mkdir(seriesdir)
+                for z in range(4):
+                    slc = sitk.Image(8, 8, sitk.sitkInt16)
+                    slc.SetMetaData("0008|0060", "MR")
+                    slc.SetMetaData("0020|000e", uid)
+                    slc.SetMetaData("0020|0032", "0\\0\\"+str(z))
+                    writer = sitk.ImageFileWriter()
+                    writer.KeepOriginalImageUIDOn()
+                    writer.SetFileName(seriesdir+"/"+str(z)+".dcm")
+                    writer.Execute(slc)
+
+            imgs, count = dicomutils.loadSeries(mrdir, 2)
+            streamed = [img.GetSize() for img in dicomutils.streamSeries(mrdir, 2)]
+            self.assertEqual(count, 3)
+            self.assertEqual(streamed, [img.GetSize() for img in imgs])
+            self.assertEqual(streamed, [(8, 8, 4)]*3)
+
+            # the CT test series is filtered out, as in loadSeries
+            self.assertEqual(list(dicomutils.streamSeries(TestDicomUtils.TMPDIR, 2)), [])
+        finally:
+            shutil.rmtree(mrdir)
+
     def test_loadZipDicom(self):
         print("\nTesting DicomUtils.loadZipDicom")
         zf = zipfile.ZipFile('tests/testzip.zip', 'w')
@@ -71,7 +257,16 @@ class TestDicomUtils(unittest.TestCase):
         print(img.GetSize())
         print(mod)
         os.unlink('tests/testzip.zip')
-        shutil.rmtree('tests/ziptmp')
+        self.assertFalse(os.path.exists('tests/ziptmp'))
+        self.assertEqual(mod, "CT")
+
+        ref, refmod = dicomutils.loadLargestSeries(TestDicomUtils.TMPDIR)
+        self.assertEqual(img.GetSize(), ref.GetSize())
+        self.assertEqual(img.GetPixelID(), ref.GetPixelID())
+        self.assertEqual(img.GetOrigin(), ref.GetOrigin())
+        self.assertEqual(img.GetSpacing(), ref.GetSpacing())
+        diff = sitk.GetArrayFromImage(img) - sitk.GetArrayFromImage(ref)
+        self.assertEqual(abs(diff).max(), 0)
 
 
 
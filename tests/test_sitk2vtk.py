@@ -5,6 +5,9 @@ from utils import sitk2vtk
 import vtk
 import SimpleITK as sitk
 import platform
+import gc
+from utils import vtk2sitk
+from vtk.util import numpy_support
 
 class TestSITK2VTK(unittest.TestCase):
 
@@ -27,6 +30,40 @@ class TestSITK2VTK(unittest.TestCase):
             print(val)
             self.assertAlmostEqual(val, 3.0)
 
+    def test_sharedBuffer(self):
+        print("Testing sitk2vtk shared buffer")
+        img = sitk.GaussianSource(sitk.sitkInt16, [40, 30, 20], mean=[20, 15, 10])
+        img.SetOrigin([1.0, -2.0, 3.5])
+        img.SetSpacing([0.5, 0.75, 2.0])
+        img.SetDirection([0, 1, 0, -1, 0, 0, 0, 0, 1])
+        expected = img[20, 15, 10]
+
+        vol = sitk2vtk.sitk2vtk(img)
+        vtkarr = numpy_support.vtk_to_numpy(vol.GetPointData().GetScalars())
+        sitkarr = sitk.GetArrayViewFromImage(img)
+        self.assertEqual(vtkarr.__array_interface__["data"][0],
+                         sitkarr.__array_interface__["data"][0])
+        vtkarr = sitkarr = None
+
+        # the VTK image keeps the SimpleITK buffer alive
+        img = None
+        gc.collect()
+        self.assertEqual(vol.GetScalarComponentAsFloat(20, 15, 10, 0), expected)
+
+        # geometry survives the round trip
+        img2 = vtk2sitk.vtk2sitk(vol)
+        self.assertEqual(img2.GetSize(), (40, 30, 20))
+        self.assertEqual(img2.GetOrigin(), (1.0, -2.0, 3.5))
+        self.assertEqual(img2.GetSpacing(), (0.5, 0.75, 2.0))
+        self.assertEqual(img2.GetDirection(), (0, 1, 0, -1, 0, 0, 0, 0, 1))
+        self.assertEqual(img2[20, 15, 10], expected)
+
+        # vector images
+        rgb = sitk.Compose([sitk.Cast(sitk.GaussianSource(sitk.sitkUInt8, [8, 8, 8]), sitk.sitkUInt8)] * 3)
+        vol = sitk2vtk.sitk2vtk(rgb)
+        self.assertEqual(vol.GetNumberOfScalarComponents(), 3)
+        self.assertEqual(vtk2sitk.vtk2sitk(vol).GetNumberOfComponentsPerPixel(), 3)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,231 @@
+#! /usr/bin/env python
+
+import unittest
+import numpy as np
+import SimpleITK as sitk
+
+from utils import sitkutils
+
+
+class TestSITKUtils(unittest.TestCase):
+
+    BALL = None
+
+    @classmethod
+    def setUpClass(cls):
+        print("Setting it up")
+        # a bright ball off to one side of a dark volume
+        img = sitk.GaussianSource(sitk.sitkInt16, [64, 64, 48], sigma=[4, 4, 4],
+                                  mean=[20, 40, 30], scale=1000)
+        img.SetOrigin([-10.0, 5.0, 2.5])
+        img.SetSpacing([0.5, 0.5, 2.0])
+        TestSITKUtils.BALL = img
+
+    def test_autoCrop(self):
+        print("Testing autoCrop")
+        img = TestSITKUtils.BALL
+        cropped = sitkutils.autoCrop(img, 300)
+        print(img.GetSize(), "->", cropped.GetSize())
+        self.assertLess(np.prod(cropped.GetSize()), np.prod(img.GetSize()))
+
+        # every voxel above the isovalue is kept, at the same physical point
+        arr = sitk.GetArrayViewFromImage(img)
+        for idx in np.argwhere(arr >= 300)[::50]:
+            point = img.TransformIndexToPhysicalPoint([int(i) for i in idx[::-1]])
+            cidx = cropped.TransformPhysicalPointToIndex(point)
+            self.assertEqual(cropped[cidx], img[[int(i) for i in idx[::-1]]])
+
+        self.assertIs(sitkutils.autoCrop(img, 5000), img)
+
+    def test_autoCropThinFeature(self):
+        print("Testing autoCrop with a one voxel thick plate")
+        img = sitk.Image(64, 64, 48, sitk.sitkInt16)
+        img[10:20, 10:20, 10:20] = 1000
+        # a plate off any 4-voxel sampling grid, far from the block
+        img[50:61, 45:58, 41] = 1000
+        index, size = sitkutils.thresholdBoundingBox(img, 300, margin=0)
+        self.assertEqual(index, [10, 10, 10])
+        self.assertEqual(size, [51, 48, 32])
+
+        cropped = sitkutils.autoCrop(img, 300)
+        point = img.TransformIndexToPhysicalPoint([55, 50, 41])
+        self.assertEqual(cropped[cropped.TransformPhysicalPointToIndex(point)], 1000)
+
+    def test_resampleVolume(self):
+        print("Testing resampleVolume")
+        img = TestSITKUtils.BALL
+
+        out = sitkutils.resampleVolume(img, voxelSize=1.0)
+        self.assertEqual(out.GetSpacing(), (1.0, 1.0, 2.0))
+        self.assertEqual(out.GetSize(), (32, 32, 48))
+        self.assertEqual(out.GetPixelID(), img.GetPixelID())
+
+        out = sitkutils.resampleVolume(img, isotropic=True)
+        self.assertEqual(out.GetSpacing(), (2.0, 2.0, 2.0))
+
+        out = sitkutils.resampleVolume(img, maxVoxels=20000)
+        print(out.GetSize(), out.GetSpacing())
+        self.assertLessEqual(np.prod(out.GetSize()), 20000)
+        self.assertAlmostEqual(out.GetSpacing()[0], out.GetSpacing()[1])
+
+        # the physical extent is kept
+        for o, s, n, o2, s2, n2 in zip(img.GetOrigin(), img.GetSpacing(), img.GetSize(),
+                                       out.GetOrigin(), out.GetSpacing(), out.GetSize()):
+            self.assertAlmostEqual(o - 0.5*s, o2 - 0.5*s2)
+            self.assertLessEqual(n*s, n2*s2 + 1e-3)
+
+        self.assertIs(sitkutils.resampleVolume(img), img)
+
+    def test_anisotropicDiffusion(self):
+        print("Testing anisotropicDiffusion")
+        img = TestSITKUtils.BALL
+        whole = sitkutils.anisotropicDiffusion(img)
+        tiled = sitkutils.anisotropicDiffusion(img, slab=8, nworkers=2)
+        self.assertEqual(tiled.GetPixelID(), img.GetPixelID())
+        self.assertEqual(tiled.GetSize(), img.GetSize())
+        self.assertEqual(tiled.GetOrigin(), img.GetOrigin())
+
+        diff = np.abs(sitk.GetArrayFromImage(whole).astype(float) -
+                      sitk.GetArrayFromImage(tiled).astype(float))
+        print("max difference", diff.max())
+        # the per slab conductance moves a few voxels by a few grey levels
+        self.assertLessEqual(diff.max(), 8)
+
+    def test_filteredSlabReader(self):
+        print("Testing filteredSlabReader")
+        arr = sitk.GetArrayFromImage(TestSITKUtils.BALL)
+        nz = arr.shape[0]
+        expected = sitk.GetArrayFromImage(sitk.Median(TestSITKUtils.BALL, [1, 1, 2]))
+        readSlab = sitkutils.filteredSlabReader(lambda z0, z1: arr[z0:z1], nz,
+                                                lambda img: sitk.Median(img, [1, 1, 2]), 2)
+        for z0 in range(0, nz, 7):
+            z1 = min(z0 + 7, nz)
+            self.assertTrue(np.array_equal(readSlab(z0, z1), expected[z0:z1]))
+
+    def test_thresholdMedianPad(self):
+        print("Testing thresholdMedianPad")
+        # two balls, only one of which reaches the narrow band, touching
+        # the volume edge
+        img = sitk.GaussianSource(sitk.sitkInt16, [64, 64, 48], sigma=[4, 4, 4],
+                                  mean=[60, 10, 30], scale=400)
+        img.CopyInformation(TestSITKUtils.BALL)
+        img = img + TestSITKUtils.BALL
+        thresholds = [100., 500., 2000., 3000.]
+
+        expected = sitk.DoubleThreshold(img, *thresholds, 255, 0)
+        expected = sitk.Median(expected, [3, 3, 1])
+        expected = sitk.ConstantPad(expected, [5, 5, 5], [5, 5, 5])
+
+        fused = sitkutils.thresholdMedianPad(img, thresholds, [3, 3, 1])
+        self.assertEqual(fused.GetPixelID(), sitk.sitkUInt8)
+        self.assertEqual(fused.GetSize(), expected.GetSize())
+        for a, b in zip(fused.GetOrigin(), expected.GetOrigin()):
+            self.assertAlmostEqual(a, b)
+        self.assertTrue(np.array_equal(sitk.GetArrayViewFromImage(fused),
+                                       sitk.GetArrayViewFromImage(expected)))
+
+        expected = sitk.DoubleThreshold(img, *thresholds, 255, 0)
+        expected = sitk.ConstantPad(expected, [5, 5, 5], [5, 5, 5])
+        fused = sitkutils.thresholdMedianPad(img, thresholds)
+        self.assertTrue(np.array_equal(sitk.GetArrayViewFromImage(fused),
+                                       sitk.GetArrayViewFromImage(expected)))
+
+        # at most a few uint8 volumes are alive at once
+        big = sitk.Expand(img, [4, 4, 4])
+        if sitkutils.resetPeakMemory():
+            for radius in ([3, 3, 1], None):
+                start = sitkutils.residentMemory()[0]
+                fused = sitkutils.thresholdMedianPad(big, thresholds, radius)
+                extra = sitkutils.residentMemory()[1] - start
+                print("thresholdMedianPad peak", extra / big.GetNumberOfPixels(), "bytes per voxel")
+                self.assertLess(extra, 4 * big.GetNumberOfPixels())
+                fused = None
+                sitkutils.resetPeakMemory()
+
+    def test_majorityFilter(self):
+        print("Testing majorityFilter")
+        img = sitk.BinaryThreshold(TestSITKUtils.BALL, 300, 5000, 255, 0)
+        noise = sitk.AdditiveGaussianNoise(sitk.Cast(img, sitk.sitkFloat32), 200, 0, 7)
+        img = sitk.BinaryThreshold(noise, 128, 1e6, 255, 0)
+        self.assertEqual(sitkutils.isBinary(img), (0, 255))
+        self.assertIsNone(sitkutils.isBinary(TestSITKUtils.BALL))
+
+        for radius in ([3, 3, 1], [1, 2, 3]):
+            expected = sitk.Median(img, radius)
+            result = sitkutils.majorityFilter(img, radius, chunk=5)
+            self.assertEqual(result.GetPixelID(), img.GetPixelID())
+            self.assertTrue(np.array_equal(sitk.GetArrayViewFromImage(result),
+                                           sitk.GetArrayViewFromImage(expected)))
+
+        # the counts are uint16 and the vote is written straight into a
+        # uint8 output, so the filter needs a few bytes per voxel
+        big = sitk.Image(256, 256, 128, sitk.sitkUInt8)
+        big[64:192, 64:192, 32:96] = 255
+        if sitkutils.resetPeakMemory():
+            start = sitkutils.residentMemory()[0]
+            result = sitkutils.majorityFilter(big, [3, 3, 1], (0, 255))
+            extra = sitkutils.residentMemory()[1] - start
+            print("majorityFilter peak", extra / big.GetNumberOfPixels(), "bytes per voxel")
+            self.assertLess(extra, 6 * big.GetNumberOfPixels())
+
+    def test_labelComponents(self):
+        print("Testing labelComponents")
+        img = sitk.Image(40, 30, 30, sitk.sitkInt16)
+        img[5:15, 5:15, 5:15] = 500
+        img[20:35, 5:25, 5:25] = 500
+        img[2:4, 2:4, 2:4] = 500
+        labels, sizes = sitkutils.labelComponents(img, 300)
+        self.assertEqual(sizes, [6000, 1000, 8])
+        self.assertEqual(labels.GetPixelID(), sitk.sitkUInt8)
+        arr = sitk.GetArrayViewFromImage(labels)
+        self.assertEqual(arr[10, 10, 25], 1)
+        self.assertEqual(arr[10, 10, 10], 2)
+
+        labels, sizes = sitkutils.labelComponents(img, 300, maxLabels=2)
+        self.assertEqual(sizes, [6000, 1000])
+        self.assertEqual(sitk.GetArrayViewFromImage(labels).max(), 2)
+        self.assertEqual(sitk.GetArrayViewFromImage(labels)[3, 3, 3], 0)
+
+        labels, sizes = sitkutils.labelComponents(img, 300, 400)
+        self.assertEqual(sizes, [])
+
+        # more regions than a uint16 can number
+        dots = np.zeros((32, 130, 130), dtype=np.int16)
+        dots[::2, ::2, ::2] = 500
+        labels, sizes = sitkutils.labelComponents(sitk.GetImageFromArray(dots), 300)
+        self.assertEqual(len(sizes), 65 * 65 * 16)
+        self.assertEqual(labels.GetPixelID(), sitk.sitkUInt32)
+        arr = sitk.GetArrayViewFromImage(labels)
+        self.assertEqual(arr.max(), len(sizes))
+        self.assertEqual(len(np.unique(arr)), len(sizes) + 1)
+
+    def test_keepLargestComponents(self):
+        print("Testing keepLargestComponents")
+        img = sitk.Image(40, 30, 30, sitk.sitkInt16)
+        img[5:15, 5:15, 5:15] = 500
+        img[20:35, 5:25, 5:25] = 500
+        img[0:4, 25:29, 0:4] = 500
+        img = sitk.SmoothingRecursiveGaussian(sitk.Cast(img, sitk.sitkFloat32), 1.0) - 100
+
+        result = sitkutils.keepLargestComponents(img, 200)
+        arr = sitk.GetArrayViewFromImage(result)
+        orig = sitk.GetArrayViewFromImage(img)
+        self.assertEqual(arr[10, 10, 10], orig.min())
+        self.assertEqual(arr[2, 27, 2], orig.min())
+        # the kept object and its surroundings are untouched
+        self.assertTrue(np.array_equal(arr[:, :, 17:], orig[:, :, 17:]))
+
+        result = sitkutils.keepLargestComponents(img, 200, count=2)
+        arr = sitk.GetArrayViewFromImage(result)
+        self.assertEqual(arr[10, 10, 10], orig[10, 10, 10])
+        self.assertEqual(arr[2, 27, 2], orig.min())
+
+    def test_memoryReport(self):
+        print("Testing memoryReport")
+        current, peak = sitkutils.memoryReport("test", TestSITKUtils.BALL)
+        self.assertGreater(current, 0)
+        self.assertGreaterEqual(peak, current)
+
+
+if __name__ == "__main__":
+    unittest.main()
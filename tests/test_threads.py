@@ -0,0 +1,29 @@
+#! /usr/bin/env python
+
+import unittest
+import SimpleITK as sitk
+
+from utils import threads
+
+
+class TestThreads(unittest.TestCase):
+
+    def test_setNumberOfThreads(self):
+        print("Testing setNumberOfThreads")
+        old = threads.getNumberOfThreads()
+        self.assertEqual(threads.setNumberOfThreads(2), 2)
+        self.assertEqual(sitk.ProcessObject.GetGlobalDefaultNumberOfThreads(), 2)
+        self.assertGreaterEqual(threads.setNumberOfThreads(0), 1)
+        threads.setNumberOfThreads(old)
+
+    def test_scalingReport(self):
+        print("Testing scalingReport")
+        img = threads._testVolume([48, 48, 32])
+        times = threads.scalingReport(2, img)
+        self.assertIn("contour", times)
+        for t in times.values():
+            self.assertEqual(len(t), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
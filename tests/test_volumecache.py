@@ -0,0 +1,75 @@
+#! /usr/bin/env python
+
+import unittest
+import os, shutil, time
+import numpy as np
+import SimpleITK as sitk
+
+from utils import dicomutils
+from utils import volumecache
+from tests import create_data
+from tests import write_series
+
+
+class TestVolumeCache(unittest.TestCase):
+
+    TMPDIR = "cachetmp"
+    CACHEDIR = "tests/volcache"
+    SIZE = 32
+
+    @classmethod
+    def setUpClass(cls):
+        print("\nBuildin\' it up!")
+        cyl = create_data.make_cylinder(TestVolumeCache.SIZE, sitk.sitkUInt16)
+        try:
+            os.mkdir(TestVolumeCache.TMPDIR)
+        except:
+            print("Oopsie")
+        write_series.write_series(cyl, TestVolumeCache.TMPDIR)
+
+    @classmethod
+    def tearDownClass(cls):
+        print("\nTearin\' it down!")
+        shutil.rmtree(TestVolumeCache.TMPDIR)
+        shutil.rmtree(TestVolumeCache.CACHEDIR, ignore_errors=True)
+
+    def test_loadSeriesSetCached(self):
+        print("\nTesting VolumeCache.loadSeriesSetCached")
+        ss = dicomutils.largestSeries(dicomutils.indexDicomDir(TestVolumeCache.TMPDIR))
+        key = volumecache.seriesKey(ss)
+        self.assertTrue(key.startswith(ss[0]))
+        self.assertIsNone(volumecache.loadCachedVolume(TestVolumeCache.CACHEDIR, key))
+
+        img, modality = volumecache.loadSeriesSetCached(ss, TestVolumeCache.CACHEDIR)
+        cached, modality2 = volumecache.loadSeriesSetCached(ss, TestVolumeCache.CACHEDIR)
+        self.assertEqual(modality, modality2)
+        self.assertEqual(img.GetPixelID(), cached.GetPixelID())
+        self.assertEqual(img.GetOrigin(), cached.GetOrigin())
+        self.assertEqual(img.GetSpacing(), cached.GetSpacing())
+        self.assertEqual(img.GetDirection(), cached.GetDirection())
+        self.assertTrue(np.array_equal(sitk.GetArrayViewFromImage(img),
+                                       sitk.GetArrayViewFromImage(cached)))
+
+        # read back in chunks that don't divide the volume
+        cached, modality2 = volumecache.loadCachedVolume(TestVolumeCache.CACHEDIR, key, chunk=5)
+        self.assertTrue(np.array_equal(sitk.GetArrayViewFromImage(img),
+                                       sitk.GetArrayViewFromImage(cached)))
+
+    def test_evictVolumeCache(self):
+        print("\nTesting VolumeCache.evictVolumeCache")
+        cacheDir = TestVolumeCache.CACHEDIR + "/evict"
+        img = sitk.Image([16, 16, 16], sitk.sitkInt16)
+        for key in ["a", "b", "c"]:
+            volumecache.storeCachedVolume(cacheDir, key, img, "CT")
+            time.sleep(0.01)
+        # use "a", so "b" is the least recently used
+        volumecache.loadCachedVolume(cacheDir, "a")
+        entry = os.path.getsize(cacheDir + "/a.npy") + os.path.getsize(cacheDir + "/a.json")
+        volumecache.evictVolumeCache(cacheDir, 2*entry)
+        self.assertIsNone(volumecache.loadCachedVolume(cacheDir, "b"))
+        self.assertIsNotNone(volumecache.loadCachedVolume(cacheDir, "a"))
+        self.assertIsNotNone(volumecache.loadCachedVolume(cacheDir, "c"))
+
+
+if __name__ == "__main__":
+    unittest.main()
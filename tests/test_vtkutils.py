@@ -82,6 +82,131 @@ class TestVTKUtils(unittest.TestCase):
             self.fail("readMesh failed")
 
 
+    def test_extractSurface(self):
+        print("Testing extractSurface")
+        source = vtk.vtkRTAnalyticSource()
+        source.SetWholeExtent(-16, 15, -16, 15, -16, 15)
+        source.Update()
+        vol = source.GetOutput()
+
+        expected = vtkutils.extractSurface(vol, 150.0, "contour")
+        self.assertGreater(expected.GetNumberOfPolys(), 0)
+        for engine in vtkutils.ENGINES + ["auto"]:
+            mesh = vtkutils.extractSurface(vol, 150.0, engine)
+            self.assertEqual(mesh.GetNumberOfPolys(), expected.GetNumberOfPolys())
+            for a, b in zip(mesh.GetBounds(), expected.GetBounds()):
+                self.assertAlmostEqual(a, b, 4)
+        self.assertIn(vtkutils.pickEngine(), vtkutils.ENGINES)
+
+        meshes = vtkutils.extractSurface(vol, [100.0, 150.0, 200.0])
+        self.assertEqual(len(meshes), 3)
+        self.assertEqual(meshes[1].GetNumberOfPolys(), expected.GetNumberOfPolys())
+        self.assertNotEqual(meshes[0].GetNumberOfPolys(), meshes[2].GetNumberOfPolys())
+
+    def test_extractSurfaceStreamed(self):
+        print("Testing extractSurfaceStreamed")
+        import numpy as np
+        img = sitk.GaussianSource(sitk.sitkInt16, [40, 36, 50], sigma=[8, 8, 12],
+                                  mean=[20, 18, 25], scale=1000)
+        img.SetSpacing([0.5, 0.6, 1.5])
+        img.SetOrigin([10.0, -4.0, 3.0])
+        arr = sitk.GetArrayFromImage(img)
+
+        padded = sitk.ConstantPad(img, [5, 5, 5], [5, 5, 5])
+        vol = vtk.vtkImageData()
+        vol.SetDimensions(padded.GetSize())
+        vol.SetSpacing(padded.GetSpacing())
+        vol.SetOrigin(padded.GetOrigin())
+        from vtk.util import numpy_support
+        vol.GetPointData().SetScalars(numpy_support.numpy_to_vtk(
+            sitk.GetArrayFromImage(padded).reshape(-1), deep=True))
+        # merging drops the degenerate triangles of voxels right on the isovalue
+        clean = vtk.vtkCleanPolyData()
+        clean.SetInputData(vtkutils.extractSurface(vol, 300.0))
+        clean.SetTolerance(0.0)
+        clean.Update()
+        expected = clean.GetOutput()
+
+        reads = []
+        def readSlab(z0, z1):
+            reads.append(z1 - z0)
+            return arr[z0:z1]
+
+        mesh = vtkutils.extractSurfaceStreamed(readSlab, img.GetSize(), img.GetSpacing(),
+                                               img.GetOrigin(), 300.0, slab=8)
+        self.assertLessEqual(max(reads), 9)
+        self.assertEqual(mesh.GetNumberOfPolys(), expected.GetNumberOfPolys())
+        self.assertEqual(vtkutils.boundaryEdges(expected), 0)
+        self.assertEqual(vtkutils.boundaryEdges(mesh), 0)
+        for a, b in zip(mesh.GetBounds(), expected.GetBounds()):
+            self.assertAlmostEqual(a, b, 4)
+
+        # several isovalues from one pass over the slabs
+        onePass = sum(reads)
+        del reads[:]
+        meshes = vtkutils.extractSurfaceStreamed(readSlab, img.GetSize(), img.GetSpacing(),
+                                                 img.GetOrigin(), [300.0, 600.0], slab=8)
+        self.assertEqual(sum(reads), onePass)
+        self.assertEqual(meshes[0].GetNumberOfPolys(), mesh.GetNumberOfPolys())
+        self.assertGreater(meshes[1].GetNumberOfPolys(), 0)
+        self.assertLess(meshes[1].GetNumberOfPolys(), mesh.GetNumberOfPolys())
+
+        # an engine this VTK doesn't have falls back to contour
+        from unittest import mock
+        realFilter = vtkutils.surfaceFilter
+        with mock.patch.object(vtkutils, "surfaceFilter",
+                               lambda e: None if e == "flyingedges" else realFilter(e)):
+            fallback = vtkutils.extractSurfaceStreamed(readSlab, img.GetSize(), img.GetSpacing(),
+                                                       img.GetOrigin(), 300.0, slab=8,
+                                                       engine="flyingedges")
+        self.assertEqual(fallback.GetNumberOfPolys(), mesh.GetNumberOfPolys())
+
+    def test_extractLabelSurfaces(self):
+        print("Testing extractLabelSurfaces")
+        from utils import sitk2vtk
+        img = sitk.Image(40, 30, 30, sitk.sitkUInt8)
+        img.SetSpacing([0.5, 0.5, 2.0])
+        img[5:15, 5:15, 5:15] = 2
+        img[20:35, 5:25, 5:25] = 1
+        img = sitk.ConstantPad(img, [1, 1, 1], [1, 1, 1])
+        meshes = vtkutils.extractLabelSurfaces(sitk2vtk.sitk2vtk(img), [1, 2])
+        self.assertEqual(len(meshes), 2)
+        for label, mesh in zip([1, 2], meshes):
+            self.assertGreater(mesh.GetNumberOfPolys(), 0)
+            self.assertEqual(vtkutils.boundaryEdges(mesh), 0)
+            # the same object as the isosurface of its mask
+            mask = sitk2vtk.sitk2vtk(sitk.Cast(img == label, sitk.sitkUInt8))
+            iso = vtkutils.extractSurface(mask, 0.5)
+            for a, b in zip(mesh.GetBounds(), iso.GetBounds()):
+                self.assertAlmostEqual(a, b, 4)
+
+    def test_largestComponentMesh(self):
+        print("Testing keepLargestComponents with the mesh connectivity filter")
+        from utils import sitk2vtk
+        from utils import sitkutils
+        # a hollow box, with an enclosed cavity, and a small block apart
+        img = sitk.Image(50, 40, 40, sitk.sitkInt16)
+        img[5:35, 5:35, 5:35] = 500
+        img[15:25, 15:25, 15:25] = 0
+        img[40:46, 5:11, 5:11] = 500
+        img = sitk.ConstantPad(img, [5, 5, 5], [5, 5, 5])
+
+        full = vtkutils.extractSurface(sitk2vtk.sitk2vtk(img), 300.0)
+        expected = vtkutils.cleanMesh(full, True)
+        kept = sitkutils.keepLargestComponents(img, 300.0)
+        mesh = vtkutils.extractSurface(sitk2vtk.sitk2vtk(kept), 300.0)
+        # the box alone still has two surfaces, the shell and the cavity
+        self.assertGreater(vtkutils.cleanMesh(mesh).GetNumberOfPolys(),
+                           expected.GetNumberOfPolys())
+        mesh = vtkutils.cleanMesh(mesh, True)
+        self.assertEqual(mesh.GetNumberOfPolys(), expected.GetNumberOfPolys())
+
+        # the two largest regions are the shell and the cavity
+        two = vtkutils.cleanMesh(full, 2)
+        self.assertEqual(two.GetNumberOfPolys(),
+                         vtkutils.cleanMesh(vtkutils.extractSurface(sitk2vtk.sitk2vtk(kept), 300.0))
+                         .GetNumberOfPolys())
+
     def test_readVTKVolume(self):
         print("Testing readVTKVolume")
         tetra = create_data.make_tetra(32)
@@ -19,7 +19,15 @@ import sys
 import os
 import fnmatch
 import zipfile
+import json
+import sqlite3
+import multiprocessing
+import concurrent.futures
+import threading
+import queue
+import numpy as np
 import SimpleITK as sitk
+import pydicom
 from tqdm import tqdm
 
 
@@ -30,13 +38,299 @@ def scanDirForDicom(dicomdir):
         #print(root,dirnames,filenames)
         for filename in filenames: #fnmatch.filter(filenames, '*.dcm'):
             matches.append(os.path.join(root, filename))
-            if root not in dirs:
-                dirs.append(root)
+        # os.walk visits each directory once, so no membership check needed
+        if len(filenames):
+            dirs.append(root)
     #print(matches)
     #print(dirs)
     return (matches, dirs)
 
 
+#
+#   Single pass, header only series indexing
+#
+
+# The Dicom tags read by the indexer.  Pixel data is never read.
+INDEX_TAGS = ["SeriesInstanceUID", "Modality", "BodyPartExamined", "PatientID",
+              "ImagePositionPatient", "ImageOrientationPatient", "InstanceNumber",
+              "PixelSpacing"]
+
+# Below this many files a process pool costs more than it saves.
+PARALLEL_MIN_FILES = 64
+
+
+def _floatList(value):
+    try:
+        return [float(x) for x in value]
+    except:
+        return None
+
+
+def readDicomHeader(fname, fp=None):
+    """
+    Read the indexing tags of a Dicom file without touching its pixel data.
+
+    fp is an optional open file object (e.g. a zip member) to read from
+    in place of fname.  Returns a dictionary of tag values, or None if
+    the file isn't Dicom.  Files without the preamble and "DICM" marker
+    are read too, as GDCM does; anything else without a
+    SeriesInstanceUID is rejected.
+    """
+    try:
+        ds = pydicom.dcmread(fname if fp is None else fp, force=True,
+                             stop_before_pixels=True, specific_tags=INDEX_TAGS)
+    except:
+        return None
+    if "SeriesInstanceUID" not in ds:
+        return None
+
+    header = {"file": fname, "dir": os.path.dirname(fname)}
+    header["SeriesInstanceUID"] = str(ds.SeriesInstanceUID)
+    for tag in ["Modality", "BodyPartExamined", "PatientID"]:
+        header[tag] = str(ds.get(tag, ""))
+    header["ImagePositionPatient"] = _floatList(
+        ds.get("ImagePositionPatient", None))
+    header["ImageOrientationPatient"] = _floatList(
+        ds.get("ImageOrientationPatient", None))
+    header["PixelSpacing"] = _floatList(ds.get("PixelSpacing", None))
+    try:
+        header["InstanceNumber"] = int(ds.InstanceNumber)
+    except:
+        header["InstanceNumber"] = None
+    return header
+
+
+def _mapParallel(func, items, nprocs=None):
+    """
+    Map a function over a list of items using a process pool.
+
+    Falls back to a serial loop for small lists, or when the platform
+    can't fork (spawning would re-run the calling script).
+    """
+    if nprocs is None:
+        nprocs = os.cpu_count() or 1
+    if (nprocs < 2 or len(items) < PARALLEL_MIN_FILES or
+            "fork" not in multiprocessing.get_all_start_methods()):
+        return [func(x) for x in items]
+
+    chunk = max(1, len(items) // (8*nprocs))
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=nprocs,
+            mp_context=multiprocessing.get_context("fork")) as pool:
+        return list(pool.map(func, items, chunksize=chunk))
+
+
+#
+#   Header cache.  Every header read in a run goes through here, so each
+#   file is parsed at most once and the loaders, scripts and indexer all
+#   share the same tag dictionaries.
+#
+
+_headerCache = {}
+
+
+def _cacheKey(fname):
+    return os.path.abspath(fname)
+
+
+def cacheDicomHeader(fname, header):
+    """Record a header (or None for a non-Dicom file) in the header cache."""
+    _headerCache[_cacheKey(fname)] = header
+
+
+def clearDicomHeaderCache():
+    """Forget all cached headers, e.g. after files have changed on disk."""
+    _headerCache.clear()
+
+
+def getDicomTags(fname):
+    """
+    Get the header tags of a Dicom file, without reading its pixel data.
+
+    The result is cached, so repeat lookups don't touch the file.
+    Returns None if the file isn't Dicom.
+    """
+    key = _cacheKey(fname)
+    if key not in _headerCache:
+        _headerCache[key] = readDicomHeader(fname)
+    return _headerCache[key]
+
+
+def readDicomHeaders(files, nprocs=None):
+    """Read the indexing headers of a list of files, in parallel.
+    Cached headers are reused.  Non-Dicom files are dropped."""
+    missing = [f for f in files if _cacheKey(f) not in _headerCache]
+    for f, h in zip(missing, _mapParallel(readDicomHeader, missing, nprocs)):
+        cacheDicomHeader(f, h)
+    headers = [_headerCache[_cacheKey(f)] for f in files]
+    return [h for h in headers if h is not None]
+
+
+def sliceSortKey(header):
+    """
+    Sort key that orders the slices of a series the way GDCM does: by
+    position along the slice normal, then instance number, then file name.
+    """
+    pos = header["ImagePositionPatient"]
+    orient = header["ImageOrientationPatient"]
+    dist = 0.0
+    if pos is not None and len(pos) == 3:
+        if orient is not None and len(orient) == 6:
+            normal = [orient[1]*orient[5] - orient[2]*orient[4],
+                      orient[2]*orient[3] - orient[0]*orient[5],
+                      orient[0]*orient[4] - orient[1]*orient[3]]
+        else:
+            normal = [0.0, 0.0, 1.0]
+        dist = pos[0]*normal[0] + pos[1]*normal[1] + pos[2]*normal[2]
+    instance = header["InstanceNumber"]
+    if instance is None:
+        instance = 0
+    return (dist, instance, header["file"])
+
+
+def groupSeries(headers):
+    """
+    Group file headers into series sets of [series_uid, dir, sorted_files],
+    the same form returned by getAllSeries.
+    """
+    groups = {}
+    order = []
+    for h in headers:
+        key = (h["dir"], h["SeriesInstanceUID"])
+        if key not in groups:
+            groups[key] = []
+            order.append(key)
+        groups[key].append(h)
+
+    seriessets = []
+    for key in sorted(order):
+        members = sorted(groups[key], key=sliceSortKey)
+        seriessets.append([key[1], key[0], [h["file"] for h in members]])
+    return seriessets
+
+
+#
+#   Persistent series index
+#
+
+def defaultIndexFile():
+    """Default location of the persistent series index, in the user cache dir."""
+    cachedir = os.environ.get("XDG_CACHE_HOME",
+                              os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cachedir, "dicom2stl", "series_index.sqlite")
+
+
+def openSeriesIndex(indexFile):
+    """
+    Open (creating if needed) an SQLite series index.
+
+    Each file is keyed by path, size and mtime.  Non-Dicom files get a
+    row with no header so they aren't re-read either.
+    """
+    d = os.path.dirname(indexFile)
+    if d and not os.path.exists(d):
+        os.makedirs(d)
+    conn = sqlite3.connect(indexFile, timeout=60)
+    conn.execute("""CREATE TABLE IF NOT EXISTS files (
+                        path TEXT PRIMARY KEY,
+                        size INTEGER,
+                        mtime INTEGER,
+                        dir TEXT,
+                        series_uid TEXT,
+                        modality TEXT,
+                        body_part TEXT,
+                        patient_id TEXT,
+                        header TEXT)""")
+    conn.execute("CREATE INDEX IF NOT EXISTS files_series ON files (series_uid)")
+    conn.commit()
+    return conn
+
+
+def updateSeriesIndex(conn, dicomdir, nprocs=None):
+    """
+    Bring the index up to date for a directory tree and return the headers
+    of all the Dicom files in it.
+
+    Only new or changed files have their headers read.  Rows for files that
+    no longer exist are removed.
+    """
+    prefix = os.path.join(os.path.abspath(dicomdir), "")
+    files, dirs = scanDirForDicom(prefix)
+
+    known = {}
+    for path, size, mtime, header in conn.execute(
+            "SELECT path, size, mtime, header FROM files "
+            "WHERE path >= ? AND path < ?", (prefix, prefix + "\uffff")):
+        known[path] = (size, mtime, header)
+
+    headers = []
+    stale = []
+    stats = {}
+    for f in files:
+        try:
+            st = os.stat(f)
+        except OSError:
+            continue
+        stats[f] = (st.st_size, st.st_mtime_ns)
+        row = known.pop(f, None)
+        if row is not None and (row[0], row[1]) == stats[f]:
+            if row[2] is not None:
+                headers.append(json.loads(row[2]))
+                cacheDicomHeader(f, headers[-1])
+            else:
+                cacheDicomHeader(f, None)
+        else:
+            stale.append(f)
+
+    if len(stale):
+        print("Indexing", len(stale), "new or changed files")
+    fresh = _mapParallel(readDicomHeader, stale, nprocs)
+
+    with conn:
+        for f, h in zip(stale, fresh):
+            cacheDicomHeader(f, h)
+            size, mtime = stats[f]
+            if h is None:
+                conn.execute("INSERT OR REPLACE INTO files (path, size, mtime) "
+                             "VALUES (?, ?, ?)", (f, size, mtime))
+                continue
+            headers.append(h)
+            conn.execute("INSERT OR REPLACE INTO files VALUES "
+                         "(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (f, size, mtime, h["dir"], h["SeriesInstanceUID"],
+                          h["Modality"], h["BodyPartExamined"],
+                          h["PatientID"], json.dumps(h)))
+        conn.executemany("DELETE FROM files WHERE path = ?",
+                         [(f,) for f in known])
+    return headers
+
+
+def indexDicomDir(dicomdir, nprocs=None, indexFile=None):
+    """
+    Find all the Dicom series in a recursive scan of a directory.
+
+    The tree is walked once and only the headers are read, across a
+    process pool.  This replaces scanDirForDicom + getAllSeries, which
+    rescans each directory once per series.
+
+    If indexFile is given, headers are kept in a persistent SQLite index
+    and only new or changed files are read on later runs.
+    """
+    if indexFile:
+        conn = openSeriesIndex(indexFile)
+        try:
+            headers = updateSeriesIndex(conn, dicomdir, nprocs)
+        finally:
+            conn.close()
+    else:
+        files, dirs = scanDirForDicom(dicomdir)
+        headers = readDicomHeaders(files, nprocs)
+    seriessets = groupSeries(headers)
+    for ss in seriessets:
+        print(ss[0], ss[1], len(ss[2]))
+    return seriessets
+
+
 def getAllSeries(dirs):
     """Get all the Dicom series in a set of directories."""
     isr = sitk.ImageSeriesReader()
@@ -97,17 +391,8 @@ def getPatientID(img):
             patientID = ""
     return patientID
 
-def loadLargestSeries(dicomdir):
-    """
-    Load the largest Dicom series it finds in a recursive scan of
-    a directory.
-
-    Largest means has the most slices.  It also returns the modality
-    of the series.
-    """
-
-    files, dirs = scanDirForDicom(dicomdir)
-    seriessets = getAllSeries(dirs)
+def largestSeries(seriessets):
+    """Pick the series set with the most slices, or None if there are none."""
     maxsize = 0
     maxindex = -1
 
@@ -119,28 +404,96 @@ def loadLargestSeries(dicomdir):
             maxindex = count
         count = count + 1
     if maxindex < 0:
-        print("Error:  no series found")
         return None
-    isr = sitk.ImageSeriesReader()
-    ss = seriessets[maxindex]
+    return seriessets[maxindex]
+
+
+def loadSeriesSet(ss, nworkers=1, pixelType=None):
+    """
+    Load a [series_uid, dir, sorted_files] series set.  Returns the image
+    and the modality of the series.  With more than one worker or a
+    compact pixelType, the slices are decoded by loadSeriesParallel.
+    """
     files = ss[2]
-    isr.SetFileNames(files)
     print("\nLoading series", ss[0], "in directory", ss[1])
-    img = isr.Execute()
+    if (nworkers is None or nworkers > 1) or pixelType:
+        img = loadSeriesParallel(files, nworkers=nworkers, pixelType=pixelType)
+    else:
+        isr = sitk.ImageSeriesReader()
+        isr.SetFileNames(files)
+        img = isr.Execute()
 
-    firstslice = sitk.ReadImage(files[0])
-    modality = getModality(firstslice)
+    modality = getDicomTags(files[0])["Modality"]
 
     return img, modality
 
-def loadSeries(dicomdir, LOWQUALITY_SLICES_TH):
+
+def loadLargestSeries(dicomdir, indexFile=None, nworkers=1, pixelType=None):
     """
     Load the largest Dicom series it finds in a recursive scan of
     a directory.
+
+    Largest means has the most slices.  It also returns the modality
+    of the series.  If indexFile is given, the series are looked up in
+    that persistent index (see indexDicomDir).  nworkers and pixelType
+    are passed on to loadSeriesSet.
+    """
+
+    ss = largestSeries(indexDicomDir(dicomdir, indexFile=indexFile))
+    if ss is None:
+        print("Error:  no series found")
+        return None
+    return loadSeriesSet(ss, nworkers, pixelType)
+
+
+def fileListSeries(files):
+    """
+    Find the largest Dicom series in a list of files, such as an entry of
+    a dcm_organizer series manifest.  The files don't need to be sorted or
+    share a directory.  Returns a [series_uid, dir, sorted_files] set, or
+    None if there are no Dicom files.
     """
+    series = {}
+    for h in readDicomHeaders(files):
+        series.setdefault(h["SeriesInstanceUID"], []).append(h)
+    if len(series) == 0:
+        return None
+    uid = max(series, key=lambda x: len(series[x]))
+    headers = sorted(series[uid], key=sliceSortKey)
+    return [uid, os.path.dirname(headers[0]["file"]), [h["file"] for h in headers]]
+
+
+def loadFileListSeries(files, nworkers=1, pixelType=None):
+    """Load the largest Dicom series in a list of files (see fileListSeries)."""
+    ss = fileListSeries(files)
+    if ss is None:
+        print("Error:  no series found")
+        return None
+    return loadSeriesSet(ss, nworkers, pixelType)
+
+
+def _wantSeries(files):
+    """The series filter used by loadSeries and streamSeries."""
+    tags = getDicomTags(files[0])
+    modality = tags["Modality"]
+    bodyPart = tags["BodyPartExamined"]
+    return modality.find("CT") == -1 and bodyPart.find("HEAD")
+
+
+def _readSeries(files):
+    isr = sitk.ImageSeriesReader()
+    isr.SetFileNames(files)
+    return isr.Execute()
+
 
-    files, dirs = scanDirForDicom(dicomdir)
-    seriessets = getAllSeriesQLTYThrehsold(dirs, LOWQUALITY_SLICES_TH)
+def loadSeries(dicomdir, LOWQUALITY_SLICES_TH, indexFile=None):
+    """
+    Load the largest Dicom series it finds in a recursive scan of
+    a directory.
+    """
+
+    seriessets = [ss for ss in indexDicomDir(dicomdir, indexFile=indexFile)
+                  if len(ss[2]) >= LOWQUALITY_SLICES_TH]
     #maxsize = 0
     #maxindex = -1
 
@@ -152,16 +505,10 @@ def loadSeries(dicomdir, LOWQUALITY_SLICES_TH):
         return imgs, 0
 
     for serie in tqdm(seriessets, total=len(seriessets)):
-        isr = sitk.ImageSeriesReader()
         files = serie[2]
-        isr.SetFileNames(files)
-
-        firstslice = sitk.ReadImage(files[0])
-        modality = getModality(firstslice)
-        bodyPart = getBodyPart(firstslice)
 
-        if modality.find("CT") == -1 and bodyPart.find("HEAD"):
-            img = isr.Execute()
+        if _wantSeries(files):
+            img = _readSeries(files)
             imgs.append(img)
             #count += 1
 
@@ -169,20 +516,419 @@ def loadSeries(dicomdir, LOWQUALITY_SLICES_TH):
     return imgs, len(seriessets)
 
 
-def loadZipDicom(name, tempDir):
-    """ Unzip a zipfile of dicom images into a temp directory, then
-        load the series that has the most slices.
+def streamSeries(dicomdir, LOWQUALITY_SLICES_TH, prefetch=1, indexFile=None):
+    """
+    Generator version of loadSeries.  Yields one volume at a time, with
+    the same filtering.
+
+    Up to prefetch series are decoded in a background thread while the
+    caller works on the current one, so at most prefetch+1 volumes are
+    alive at once.  Drop your reference to a volume before asking for
+    the next one.
+    """
+    seriessets = [ss for ss in indexDicomDir(dicomdir, indexFile=indexFile)
+                  if len(ss[2]) >= LOWQUALITY_SLICES_TH and _wantSeries(ss[2])]
+    if len(seriessets) == 0:
+        print("Error:  no series found")
+        return
+
+    if prefetch < 1:
+        for ss in seriessets:
+            yield _readSeries(ss[2])
+        return
+
+    # One slot per volume alive: the caller's plus the prefetched ones
+    slots = threading.Semaphore(prefetch + 1)
+    results = queue.Queue()
+    stop = threading.Event()
+
+    def producer():
+        for ss in seriessets:
+            slots.acquire()
+            if stop.is_set():
+                return
+            try:
+                results.put(_readSeries(ss[2]))
+            except Exception as e:
+                results.put(e)
+                return
+
+    thread = threading.Thread(target=producer)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        for i in range(len(seriessets)):
+            img = results.get()
+            if isinstance(img, Exception):
+                raise img
+            yield img
+            img = None
+            slots.release()
+    finally:
+        stop.set()
+        slots.release()
+        thread.join()
+
+
+#
+#   Volume assembly from decoded slices
+#
+
+def seriesGeometry(headers):
+    """
+    Compute the origin, spacing and direction of a volume from the
+    sorted slice headers of its series.
+    """
+    first = headers[0]
+    orient = first.get("ImageOrientationPatient")
+    if orient is None or len(orient) != 6:
+        orient = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+    row = orient[:3]
+    col = orient[3:]
+    normal = [row[1]*col[2] - row[2]*col[1],
+              row[2]*col[0] - row[0]*col[2],
+              row[0]*col[1] - row[1]*col[0]]
+
+    origin = first.get("ImagePositionPatient")
+    if origin is None or len(origin) != 3:
+        origin = [0.0, 0.0, 0.0]
+
+    pixelSpacing = first.get("PixelSpacing")
+    if pixelSpacing is None or len(pixelSpacing) != 2:
+        pixelSpacing = [1.0, 1.0]
+
+    zspacing = 1.0
+    last = headers[-1].get("ImagePositionPatient")
+    if len(headers) > 1 and last is not None and len(last) == 3:
+        dist = sum((l-o)*n for l, o, n in zip(last, origin, normal))
+        if dist != 0.0:
+            zspacing = abs(dist) / (len(headers)-1)
+
+    # DICOM pixel spacing is (row spacing, column spacing)
+    spacing = [pixelSpacing[1], pixelSpacing[0], zspacing]
+    direction = [row[0], col[0], normal[0],
+                 row[1], col[1], normal[1],
+                 row[2], col[2], normal[2]]
+    return origin, spacing, direction
+
+
+def _rescaledType(ds, stored):
+    """Pick the pixel type for a rescaled slice, the way GDCM does."""
+    slope = float(ds.get("RescaleSlope", 1.0))
+    intercept = float(ds.get("RescaleIntercept", 0.0))
+    if slope == 1.0 and intercept == 0.0:
+        return stored
+    if not (slope.is_integer() and intercept.is_integer()):
+        return np.dtype(np.float64)
+
+    bits = int(ds.get("BitsStored", 8*stored.itemsize))
+    if int(ds.get("PixelRepresentation", 0)):
+        lo, hi = -2**(bits-1), 2**(bits-1)-1
+    else:
+        lo, hi = 0, 2**bits-1
+    lo, hi = sorted([lo*slope + intercept, hi*slope + intercept])
+    for t in (np.int16, np.int32):
+        if np.iinfo(t).min <= lo and hi <= np.iinfo(t).max:
+            return np.dtype(t)
+    return np.dtype(np.float64)
+
+
+#
+#   Compact pixel types
+#
+
+# pixel types a volume can be kept in, rather than the float64 that a
+# non-integer rescale slope or intercept gives
+PIXEL_TYPES = {"int16": np.int16, "float32": np.float32}
+
+
+def compactDtype(dtype, pixelType):
+    """
+    The dtype to keep a volume of dtype in, for pixelType "int16",
+    "float32" or None (keep dtype).  Only types larger than the target
+    are converted: a type of the same size saves nothing and could lose
+    range (uint16 to int16) or precision (int32 to float32).
+    """
+    dtype = np.dtype(dtype)
+    if not pixelType:
+        return dtype
+    target = np.dtype(PIXEL_TYPES[pixelType])
+    if dtype.itemsize <= target.itemsize:
+        return dtype
+    return target
+
+
+def toCompact(arr, dtype):
+    """
+    Convert an array to dtype, rounding to the nearest value and clipping
+    to the range of integer types.  Returns the new array and the largest
+    absolute difference from the input.
+    """
+    dtype = np.dtype(dtype)
+    if arr.dtype == dtype:
+        return arr, 0.0
+    if dtype.kind in "iu":
+        info = np.iinfo(dtype)
+        out = np.clip(np.rint(arr), info.min, info.max).astype(dtype)
+    else:
+        out = arr.astype(dtype)
+    if arr.size == 0:
+        return out, 0.0
+    err = float(np.max(np.abs(arr.astype(np.float64) - out)))
+    return out, err
+
+
+def compactImage(img, pixelType):
+    """A SimpleITK image converted to the compact pixelType (see compactDtype)."""
+    arr = sitk.GetArrayViewFromImage(img)
+    dtype = compactDtype(arr.dtype, pixelType)
+    if dtype == arr.dtype or img.GetNumberOfComponentsPerPixel() > 1:
+        return img
+    out, err = toCompact(arr, dtype)
+    result = sitk.GetImageFromArray(out)
+    result.CopyInformation(img)
+    print("Pixel type:", arr.dtype, "->", dtype, ", max error", err)
+    return result
+
+
+def decodeDicomSlice(ds, dtype=None):
+    """
+    Decode the pixels of a pydicom dataset, applying the rescale
+    slope and intercept.  Returns a 2d numpy array.
+    """
+    pixels = ds.pixel_array
+    if dtype is None:
+        dtype = _rescaledType(ds, pixels.dtype)
+    slope = float(ds.get("RescaleSlope", 1.0))
+    intercept = float(ds.get("RescaleIntercept", 0.0))
+    if slope == 1.0 and intercept == 0.0:
+        return pixels.astype(dtype, copy=False)
+    return toCompact(pixels*slope + intercept, dtype)[0]
+
+
+def volumeToImage(vol, headers):
+    """Wrap a z,y,x numpy volume as a SimpleITK image with the series geometry."""
+    return setSeriesGeometry(sitk.GetImageFromArray(vol), headers)
+
+
+def setSeriesGeometry(img, headers):
+    """Set the origin, spacing and direction of an image from the series headers."""
+    origin, spacing, direction = seriesGeometry(headers)
+    img.SetOrigin(origin)
+    img.SetSpacing(spacing)
+    img.SetDirection(direction)
+    return img
+
+
+def _decodeSliceInto(fname, out):
+    """Decode one slice file into the 2d array out.  Returns the conversion error."""
+    # keep the image referenced while its array view is in use
+    slc = sitk.ReadImage(fname)
+    out[...], err = toCompact(sitk.GetArrayViewFromImage(slc)[0], out.dtype)
+    return err
+
+
+def _decodeSlices(args):
+    """
+    Process pool worker: decode a list of slice files into a z,y,x
+    array.  Returns the array and the largest conversion error.
+    """
+    files, dtype, shape = args
+    chunk = np.empty((len(files),) + shape, dtype=dtype)
+    err = 0.0
+    for z, fname in enumerate(files):
+        err = max(err, _decodeSliceInto(fname, chunk[z]))
+    return chunk, err
+
+
+def loadSeriesParallel(files, headers=None, nworkers=None, useProcesses=False,
+                       pixelType=None, chunk=16):
+    """
+    Load a sorted list of slice files into a volume, decoding the slices
+    concurrently.
+
+    The output SimpleITK image is allocated up front, and the slices are
+    decoded chunk z-slices at a time and pasted into it, so apart from
+    the image only the chunks in flight are held.  Slices are decoded by
+    GDCM, so compressed transfer syntaxes and rescaling behave as with
+    ImageSeriesReader.  A thread pool is used, or with useProcesses a
+    process pool whose workers each return a decoded chunk.  With a
+    pixelType (see compactDtype) each slice is converted as it's decoded,
+    and the largest conversion error is reported.  Returns the image with
+    the series geometry.
+    """
+    if headers is None:
+        headers = [getDicomTags(f) for f in files]
+    if nworkers is None:
+        nworkers = os.cpu_count() or 1
+    nworkers = max(1, nworkers)
+    nz = len(files)
+
+    # The first slice sets the pixel type and slice size
+    first = sitk.GetArrayFromImage(sitk.ReadImage(files[0]))[0]
+    srcType = first.dtype
+    dtype = compactDtype(srcType, pixelType)
+    shape = first.shape
+    firstSlice, err = toCompact(first, dtype)
+    firstImage = sitk.GetImageFromArray(firstSlice[np.newaxis])
+    img = sitk.Image([shape[1], shape[0], nz], firstImage.GetPixelID())
+    img[:, :, 0:1] = firstImage
+    del first, firstImage
+    errors = [err]
+
+    def paste(z0, arr):
+        img[:, :, z0:z0 + arr.shape[0]] = sitk.GetImageFromArray(arr)
+
+    if useProcesses and nworkers > 1 and \
+            "fork" in multiprocessing.get_all_start_methods():
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=nworkers,
+                mp_context=multiprocessing.get_context("fork")) as pool:
+            def collect(z0, future):
+                arr, err = future.result()
+                paste(z0, arr)
+                errors.append(err)
+
+            # keep at most nworkers+1 chunks in flight
+            pending = []
+            for z0 in range(1, nz, chunk):
+                pending.append((z0, pool.submit(
+                    _decodeSlices, (files[z0:z0 + chunk], dtype, shape))))
+                if len(pending) > nworkers:
+                    collect(*pending.pop(0))
+            for z0, future in pending:
+                collect(z0, future)
+    else:
+        # one chunk buffer, shared by the threads
+        chunk = max(chunk, nworkers)
+        buf = np.empty((min(chunk, nz),) + shape, dtype=dtype)
+
+        def decode(z, z0):
+            return _decodeSliceInto(files[z], buf[z - z0])
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=nworkers) as pool:
+            for z0 in range(1, nz, chunk):
+                z1 = min(z0 + chunk, nz)
+                errors.extend(pool.map(decode, range(z0, z1), [z0] * (z1 - z0)))
+                paste(z0, buf[:z1 - z0])
+
+    if dtype != srcType:
+        print("Pixel type:", srcType, "->", dtype, ", max error", max(errors))
+
+    return setSeriesGeometry(img, headers)
+
+
+def seriesSlabReader(ss, pixelType=None, nworkers=1):
+    """
+    Read a [series_uid, dir, sorted_files] series set a z-slab at a time,
+    for volumes too large to load whole.  Returns a readSlab(z0, z1)
+    function, which decodes slices z0 to z1-1 into a z,y,x numpy array,
+    and the x,y,z size, origin and spacing of the volume.
+    """
+    files = ss[2]
+    headers = [getDicomTags(f) for f in files]
+    origin, spacing, direction = seriesGeometry(headers)
+
+    first = sitk.GetArrayFromImage(sitk.ReadImage(files[0]))[0]
+    dtype = compactDtype(first.dtype, pixelType)
+    dims = [first.shape[1], first.shape[0], len(files)]
+
+    def readSlab(z0, z1):
+        slab = np.empty((z1-z0,) + first.shape, dtype=dtype)
+
+        def decode(z):
+            slc = sitk.ReadImage(files[z])
+            slab[z-z0] = toCompact(sitk.GetArrayViewFromImage(slc)[0], dtype)[0]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, nworkers)) as pool:
+            list(pool.map(decode, range(z0, z1)))
+        return slab
+
+    return readSlab, dims, origin, spacing
+
+
+#
+#   Zip archives
+#
+
+def indexZipDicom(myzip):
+    """
+    Find all the Dicom series in an open zip file, reading the member
+    headers in place.  Returns the series sets and the member headers.
+    """
+    headers = []
+    for info in myzip.infolist():
+        if info.is_dir():
+            continue
+        with myzip.open(info) as fp:
+            h = readDicomHeader(info.filename, fp)
+        if h is not None:
+            headers.append(h)
+    return groupSeries(headers), headers
+
+
+def loadZipSeries(myzip, names, headers, pixelType=None):
+    """
+    Decode the named members of an open zip file straight into a volume.
+    headers maps member name to its indexing header.  pixelType is as
+    for loadSeriesParallel.
+    """
+    vol = None
+    for z, n in enumerate(names):
+        with myzip.open(n) as fp:
+            ds = pydicom.dcmread(fp, force=True)
+        if vol is None:
+            first = decodeDicomSlice(ds)
+            dtype = compactDtype(first.dtype, pixelType)
+            vol = np.empty((len(names),) + first.shape, dtype=dtype)
+            vol[0], err = toCompact(first, dtype)
+            errors = [err]
+        elif dtype != first.dtype:
+            vol[z], err = toCompact(decodeDicomSlice(ds, first.dtype), dtype)
+            errors.append(err)
+        else:
+            vol[z] = decodeDicomSlice(ds, dtype)
+    if dtype != first.dtype:
+        print("Pixel type:", first.dtype, "->", dtype, ", max error", max(errors))
+    return volumeToImage(vol, [headers[n] for n in names])
+
+
+def loadZipDicom(name, tempDir=None, pixelType=None):
+    """
+    Load the series that has the most slices from a zip file of dicom images.
+
+    Member headers are read in place and only the chosen series is
+    decoded; nothing is extracted.  If in-place decoding fails (e.g. a
+    transfer syntax pydicom can't decode) and a tempDir is given, the
+    zip is unzipped there and loaded from disk instead.  pixelType is as
+    for loadSeriesParallel.
     """
 
     print("Reading Dicom zip file:", name)
     myzip = zipfile.ZipFile(name, 'r')
 
+    try:
+        seriessets, headers = indexZipDicom(myzip)
+        if len(seriessets) == 0:
+            print("Error:  no series found")
+            return None
+        ss = max(seriessets, key=lambda x: len(x[2]))
+        print("\nLoading series", ss[0], "in zip directory", ss[1])
+        byname = {h["file"]: h for h in headers}
+        img = loadZipSeries(myzip, ss[2], byname, pixelType)
+        return img, byname[ss[2][0]]["Modality"]
+    except:
+        if not tempDir:
+            raise
+        print("Zip streaming failed, extracting to", tempDir)
+
     try:
         myzip.extractall(tempDir)
     except:
         print("Zip extract failed")
 
-    return loadLargestSeries(tempDir)
+    return loadLargestSeries(tempDir, pixelType=pixelType)
 
 
 #
@@ -15,22 +15,30 @@ from numpy import *
 from vtk.util import numpy_support
 
 
-def sitk2vtk(img, debugOn=False):
-    """Convert a SimpleITK image to a VTK image, via numpy."""
+def sitk2vtk(img, debugOn=False, deepCopy=False):
+    """
+    Convert a SimpleITK image to a VTK image, via numpy.
+
+    Unless deepCopy is set, the VTK image shares the SimpleITK pixel
+    buffer, and the VTK array keeps the SimpleITK image alive.  The
+    SimpleITK image must not be modified while the VTK image is in use.
+    """
 
     size = list(img.GetSize())
     origin = list(img.GetOrigin())
     spacing = list(img.GetSpacing())
+    direction = list(img.GetDirection())
     sitktype = img.GetPixelID()
     #vtktype = pixelmap[sitktype]
     ncomp = img.GetNumberOfComponentsPerPixel()
 
-    # there doesn't seem to be a way to specify the image orientation in VTK
-
     # convert the SimpleITK image to a numpy array
-    i2 = sitk.GetArrayFromImage(img)
+    if deepCopy:
+        i2 = sitk.GetArrayFromImage(img)
+    else:
+        i2 = sitk.GetArrayViewFromImage(img)
     if debugOn:
-        i2_string = i2.tostring()
+        i2_string = i2.tobytes()
         print("data string address inside sitk2vtk", hex(id(i2_string)))
 
     vtk_image = vtk.vtkImageData()
@@ -45,13 +53,23 @@ def sitk2vtk(img, debugOn=False):
     if len(spacing) == 2:
         spacing.append(spacing[0])
 
+    if len(direction) == 4:
+        direction = [direction[0], direction[1], 0.0,
+                     direction[2], direction[3], 0.0,
+                     0.0, 0.0, 1.0]
+
     vtk_image.SetDimensions(size)
     vtk_image.SetSpacing(spacing)
     vtk_image.SetOrigin(origin)
     vtk_image.SetExtent(0, size[0]-1, 0, size[1]-1, 0, size[2]-1)
+    if hasattr(vtk_image, "SetDirectionMatrix"):
+        # VTK 9 and later
+        vtk_image.SetDirectionMatrix(direction)
+
     #depth_array = numpy_support.numpy_to_vtk(i2.ravel(), deep=True, array_type = vtktype)
-    depth_array = numpy_support.numpy_to_vtk(i2.ravel())
-    depth_array.SetNumberOfComponents(ncomp)
+    depth_array = numpy_support.numpy_to_vtk(i2.reshape(-1, ncomp), deep=False)
+    # numpy_to_vtk holds the numpy array, which doesn't hold the image
+    depth_array._sitk_image = img
     vtk_image.GetPointData().SetScalars(depth_array)
 
     vtk_image.Modified()
@@ -64,7 +82,7 @@ def sitk2vtk(img, debugOn=False):
         print(size)
         print(origin)
         print(spacing)
+        print(direction)
         print(vtk_image.GetScalarComponentAsFloat(0, 0, 0, 0))
 
     return vtk_image
-
@@ -0,0 +1,568 @@
+#! /usr/bin/env python
+
+"""
+A collection of SimpleITK functions for processing volumes before
+surface extraction.
+
+It is covered by the Apache License, Version 2.0:
+http://www.apache.org/licenses/LICENSE-2.0
+"""
+
+from __future__ import print_function
+import sys
+import os
+import time
+import math
+import threading
+import concurrent.futures
+import numpy as np
+import SimpleITK as sitk
+
+#
+#  timing knick knacks
+#
+
+
+def roundThousand(x):
+    y = int(1000.0*x+0.5)
+    return str(float(y) * .001)
+
+
+def elapsedTime(start_time):
+    dt = roundThousand(time.perf_counter()-start_time)
+    print("    ", dt, "seconds")
+
+
+#
+#  Memory
+#
+
+
+def availableMemory():
+    """Available physical memory in bytes, or None if it can't be found."""
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except:
+        return None
+
+
+def residentMemory():
+    """
+    Current and peak resident memory of the process in bytes.  The peak
+    is since the last resetPeakMemory, where that works.
+    """
+    peak = 0
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    peak = int(line.split()[1]) * 1024
+    except:
+        pass
+    if not peak:
+        try:
+            import resource
+            # kilobytes on Linux
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        except:
+            pass
+    try:
+        with open("/proc/self/statm") as f:
+            current = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except:
+        current = peak
+    return current, max(current, peak)
+
+
+def resetPeakMemory():
+    """
+    Reset the peak resident memory to the current size (Linux).  Returns
+    False if it can't be reset.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except:
+        return False
+
+
+def memoryReport(stage, img=None):
+    """
+    Print the resident memory after a pipeline stage, and the size and
+    pixel type of the stage's image.  Returns (current, peak) bytes.
+    """
+    current, peak = residentMemory()
+    MB = 1024.0 * 1024.0
+    line = "Memory after %-12s rss %8.1f MB, peak %8.1f MB" % (stage, current/MB, peak/MB)
+    if img is not None:
+        nbytes = img.GetNumberOfPixels() * img.GetSizeOfPixelComponent() * \
+            img.GetNumberOfComponentsPerPixel()
+        line = line + ", image %8.1f MB %s" % (nbytes/MB, img.GetPixelIDTypeAsString())
+    print(line)
+    return current, peak
+
+
+def memoryLimitedWorkers(perWorker, maxWorkers):
+    """
+    Number of workers, up to maxWorkers and the cpu count, that each
+    need perWorker bytes and fit in the available memory.
+    """
+    n = min(maxWorkers, os.cpu_count() or 1)
+    mem = availableMemory()
+    if mem is not None and perWorker > 0:
+        n = min(n, int(mem // perWorker))
+    return max(1, n)
+
+
+#
+#  Region of interest
+#
+
+
+def thresholdBoundingBox(img, lower, upper=None, margin=8, chunk=16):
+    """
+    Find the bounding box of the voxels with values in [lower, upper]
+    (upper=None means no upper limit).
+
+    The volume is thresholded at full resolution, chunk z-slices at a
+    time, and each chunk's mask is reduced to its x, y and z
+    projections, so even a one voxel thick structure is found.  The box
+    is grown by margin voxels, a number or an x,y,z list, to cover the
+    support of later filters.  Returns an (index, size) pair in voxels,
+    or None if no voxels are in range.
+    """
+    size = img.GetSize()
+    if not isinstance(margin, (list, tuple)):
+        margin = [margin] * len(size)
+    arr = sitk.GetArrayViewFromImage(img)
+
+    # numpy axes are z,y,x
+    hits = [np.zeros(n, dtype=bool) for n in size]
+    for z0 in range(0, arr.shape[0], chunk):
+        mask = arr[z0:z0 + chunk] >= lower
+        if upper is not None:
+            mask &= arr[z0:z0 + chunk] <= upper
+        hits[0] |= mask.any(axis=(0, 1))
+        hits[1] |= mask.any(axis=(0, 2))
+        hits[2][z0:z0 + chunk] = mask.any(axis=(1, 2))
+    if not hits[2].any():
+        return None
+
+    index = []
+    boxsize = []
+    for axis in range(len(size)):
+        found = np.nonzero(hits[axis])[0]
+        lo = max(0, found[0] - margin[axis])
+        hi = min(size[axis], found[-1] + 1 + margin[axis])
+        index.append(int(lo))
+        boxsize.append(int(hi - lo))
+    return index, boxsize
+
+
+def autoCrop(img, lower, upper=None, margin=8):
+    """
+    Crop a volume to the bounding box of the voxels in [lower, upper]
+    (see thresholdBoundingBox).  The cropped image keeps its physical
+    origin, so surfaces extracted from it line up with the full volume.
+    Returns the image unchanged if nothing is in range.
+    """
+    t = time.perf_counter()
+    box = thresholdBoundingBox(img, lower, upper, margin)
+    if box is None:
+        print("Auto crop: no voxels in range, not cropping")
+        return img
+    index, size = box
+    if list(size) == list(img.GetSize()):
+        return img
+    cropped = sitk.RegionOfInterest(img, size, index)
+    print("Auto crop: ", img.GetSize(), "->", cropped.GetSize())
+    elapsedTime(t)
+    return cropped
+
+
+#
+#  Resampling
+#
+
+
+def resampleSpacing(img, voxelSize=None, maxVoxels=None, isotropic=False):
+    """
+    Compute the output spacing for resampleVolume.
+
+    voxelSize is the target voxel size in physical units; axes that are
+    already coarser are left alone.  isotropic makes all axes the same,
+    voxelSize if given, otherwise the coarsest input spacing.  maxVoxels
+    is a voxel count budget: the finest axes are coarsened together
+    until the volume fits it.
+    """
+    spacing = list(img.GetSpacing())
+    size = list(img.GetSize())
+    extent = [sz*sp for sz, sp in zip(size, spacing)]
+
+    if isotropic:
+        h = voxelSize if voxelSize else max(spacing)
+        newSpacing = [h] * len(spacing)
+    elif voxelSize:
+        newSpacing = [max(sp, voxelSize) for sp in spacing]
+    else:
+        newSpacing = spacing
+
+    def count(sp):
+        return np.prod([max(1, int(math.ceil(e/s - 1e-6))) for e, s in zip(extent, sp)])
+
+    if maxVoxels and count(newSpacing) > maxVoxels:
+        # bisect for the smallest floor spacing that meets the budget
+        lo = min(newSpacing)
+        hi = max(extent)
+        for i in range(50):
+            mid = 0.5 * (lo+hi)
+            if count([max(s, mid) for s in newSpacing]) > maxVoxels:
+                lo = mid
+            else:
+                hi = mid
+        newSpacing = [max(s, hi) for s in newSpacing]
+    return newSpacing
+
+
+def resampleVolume(img, voxelSize=None, maxVoxels=None, isotropic=False,
+                   antialias=True, interpolator=sitk.sitkLinear):
+    """
+    Resample a volume to the spacing given by resampleSpacing, keeping its
+    physical extent.  When downsampling, the volume is first smoothed with
+    a Gaussian sized to the change in spacing, to avoid aliasing.
+    """
+    t = time.perf_counter()
+    spacing = list(img.GetSpacing())
+    size = list(img.GetSize())
+    newSpacing = resampleSpacing(img, voxelSize, maxVoxels, isotropic)
+    if newSpacing == spacing:
+        return img
+    newSize = [max(1, int(math.ceil(sz*sp/ns - 1e-6)))
+               for sz, sp, ns in zip(size, spacing, newSpacing)]
+
+    if antialias:
+        variance = [0.25*max(0.0, ns*ns - sp*sp)
+                    for sp, ns in zip(spacing, newSpacing)]
+        if max(variance) > 0.0:
+            img = sitk.DiscreteGaussian(img, variance, 32, 0.01, True)
+
+    # keep the outer edge of the volume where it was
+    direction = img.GetDirection()
+    dim = len(size)
+    shift = [0.5*(ns - sp) for sp, ns in zip(spacing, newSpacing)]
+    origin = list(img.GetOrigin())
+    for r in range(dim):
+        for c in range(dim):
+            origin[r] += direction[r*dim + c] * shift[c]
+
+    result = sitk.Resample(img, newSize, sitk.Transform(), interpolator, origin,
+                           newSpacing, direction, 0.0, img.GetPixelID())
+    print("Resample: ", size, "->", newSize, ", spacing", newSpacing)
+    elapsedTime(t)
+    return result
+
+
+#
+#  Smoothing
+#
+
+
+def diffusionHalo(iterations=5):
+    """
+    Number of slices anisotropicDiffusion reaches on each side of a
+    voxel: each iteration's curvature term takes differences of
+    differences, two slices deep.
+    """
+    return 2 * iterations
+
+
+def anisotropicDiffusion(img, timeStep=.03, iterations=5, conductance=3.0,
+                         slab=0, halo=None, nworkers=None, nthreads=None):
+    """
+    Curvature anisotropic diffusion that returns an image of the input
+    pixel type.
+
+    With slab > 0 the volume is processed in z-slabs of that many slices,
+    each padded with halo slices (default diffusionHalo) on both sides and
+    smoothed as float in a pool of nworkers threads.  Each slab's core is
+    cast back and pasted into the preallocated output image, so the only
+    full-size buffer is the output.  Note that the conductance scaling
+    is computed per slab, so results can differ by a few grey levels from
+    the whole-volume filter.
+    """
+    t = time.perf_counter()
+    pixelType = img.GetPixelID()
+    size = img.GetSize()
+    if slab <= 0 or slab >= size[2]:
+        fimg = sitk.Cast(img, sitk.sitkFloat32)
+        fimg = sitk.CurvatureAnisotropicDiffusion(fimg, timeStep, conductance,
+                                                  1, iterations)
+        result = sitk.Cast(fimg, pixelType)
+        elapsedTime(t)
+        return result
+
+    if halo is None:
+        halo = diffusionHalo(iterations)
+    if nthreads is None:
+        nthreads = sitk.ProcessObject.GetGlobalDefaultNumberOfThreads()
+    if nworkers is None:
+        nworkers = nthreads
+    nworkers = max(1, min(nworkers, int(math.ceil(size[2] / float(slab)))))
+    # split the threads among the slabs in flight
+    slabThreads = max(1, nthreads // nworkers)
+
+    result = sitk.Image(size, pixelType)
+    result.CopyInformation(img)
+    # pasting works in place on result, so one slab at a time
+    pasteLock = threading.Lock()
+
+    def smoothSlab(z0):
+        z1 = min(z0 + slab, size[2])
+        h0 = max(0, z0 - halo)
+        h1 = min(size[2], z1 + halo)
+        piece = sitk.RegionOfInterest(img, [size[0], size[1], h1 - h0], [0, 0, h0])
+        piece = sitk.Cast(piece, sitk.sitkFloat32)
+        f = sitk.CurvatureAnisotropicDiffusionImageFilter()
+        f.SetTimeStep(timeStep)
+        f.SetConductanceParameter(conductance)
+        f.SetNumberOfIterations(iterations)
+        f.SetNumberOfThreads(slabThreads)
+        piece = f.Execute(piece)
+        piece = sitk.RegionOfInterest(piece, [size[0], size[1], z1 - z0],
+                                      [0, 0, z0 - h0])
+        piece = sitk.Cast(piece, pixelType)
+        with pasteLock:
+            result[:, :, z0:z1] = piece
+        return z1 - z0
+
+    print("Anisotropic diffusion: ", int(math.ceil(size[2] / float(slab))),
+          "slabs of", slab, "slices, halo", halo, ",", nworkers, "workers")
+    with concurrent.futures.ThreadPoolExecutor(nworkers) as pool:
+        list(pool.map(smoothSlab, range(0, size[2], slab)))
+
+    elapsedTime(t)
+    return result
+
+
+def filteredSlabReader(readSlab, nz, func, halo, spacing=None):
+    """
+    Wrap a readSlab(z0, z1) function, as used by
+    vtkutils.extractSurfaceStreamed, so that each slab is read with halo
+    extra slices on both sides, filtered by func (a SimpleITK image to
+    image function) and trimmed back.  A filter that reaches no further
+    than halo slices gives the same slices as on the whole volume.
+    """
+    def filteredSlab(z0, z1):
+        h0 = max(0, z0 - halo)
+        h1 = min(nz, z1 + halo)
+        img = sitk.GetImageFromArray(readSlab(h0, h1))
+        if spacing is not None:
+            img.SetSpacing(spacing)
+        img = func(img)
+        return sitk.GetArrayFromImage(img)[z0 - h0:z1 - h0]
+    return filteredSlab
+
+
+#
+#  Thresholding
+#
+
+
+def isBinary(img, chunk=16):
+    """
+    Return (background, foreground) if the image holds at most two
+    values, otherwise None.
+    """
+    arr = sitk.GetArrayViewFromImage(img)
+    lo = arr.min()
+    hi = arr.max()
+    for z in range(0, arr.shape[0], chunk):
+        s = arr[z:z + chunk]
+        if np.count_nonzero(s == lo) + np.count_nonzero(s == hi) != s.size:
+            return None
+    return lo, hi
+
+
+def _boxSum(a, r, axis, dtype):
+    """
+    Sum over a window of 2r+1 along axis, replicating the edges.  The
+    shifted slices are added in place, so the only new array is the
+    output.
+    """
+    out = a.astype(dtype)
+    if r == 0:
+        return out
+    src = np.moveaxis(a, axis, 0)
+    dst = np.moveaxis(out, axis, 0)
+    n = src.shape[0]
+    for k in range(1, r + 1):
+        # offsets -k and +k, past the edges the edge slice is repeated
+        m = min(k, n)
+        dst[m:] += src[:n - m]
+        dst[:m] += src[0]
+        dst[:n - m] += src[m:]
+        dst[n - m:] += src[n - 1]
+    return out
+
+
+def majorityFilter(img, radius=[3, 3, 1], values=None, chunk=16, pad=0):
+    """
+    Median filter for a binary image, computed as a majority vote with
+    separable box sums.  Gives the same result as sitk.Median, at a cost
+    that grows with the sum of the radii rather than the kernel volume.
+
+    values is (background, foreground), found from the image if not
+    given.  The vote is counted chunk slices at a time, each with a halo
+    of radius[2] slices, and pasted into the output image, so the only
+    full-size buffer is the output.  With pad > 0 the output has pad
+    zero voxels on every side, as sitk.ConstantPad would add.
+    """
+    t = time.perf_counter()
+    if values is None:
+        values = isBinary(img)
+        if values is None:
+            raise ValueError("majorityFilter needs a binary image")
+    bg, fg = values
+    n = 1
+    for r in radius:
+        n = n * (2*r + 1)
+    dtype = np.uint16 if n < 65536 else np.uint32
+
+    src = sitk.GetArrayViewFromImage(img)
+    nz = src.shape[0]
+    rz = radius[2]
+    p = pad
+    result = sitk.Image([s + 2*p for s in img.GetSize()], img.GetPixelID())
+    result.SetSpacing(img.GetSpacing())
+    result.SetDirection(img.GetDirection())
+    result.SetOrigin(img.TransformContinuousIndexToPhysicalPoint([-p] * 3))
+    nx, ny = img.GetSize()[:2]
+    for z0 in range(0, nz, chunk):
+        z1 = min(z0 + chunk, nz)
+        h0 = max(0, z0 - rz)
+        h1 = min(nz, z1 + rz)
+        count = src[h0:h1] == fg
+        # numpy axes are z, y, x; the z sums are only wrong in the halo
+        for axis, r in ((2, radius[0]), (1, radius[1]), (0, rz)):
+            count = _boxSum(count, r, axis, dtype)
+        count = count[z0 - h0:z1 - h0]
+        out = np.full(count.shape, bg, dtype=src.dtype)
+        out[count > n // 2] = fg
+        del count
+        result[p:p + nx, p:p + ny, p + z0:p + z1] = sitk.GetImageFromArray(out)
+    elapsedTime(t)
+    return result
+
+
+def thresholdMedianPad(img, thresholds, medianRadius=None, pad=5):
+    """
+    Replacement for DoubleThreshold (255/0), an optional Median and a
+    ConstantPad of pad voxels.
+
+    The narrow [t1, t2] mask is grown inside the wide [t0, t3] mask by
+    grayscale reconstruction, as DoubleThreshold does, which gives 255/0
+    directly from 255/0 masks.  The reconstruction floods through the
+    whole volume, so it needs both masks whole and is a separate step.
+    The median and the pad are fused: majorityFilter votes z-slabs of
+    the reconstruction straight into the padded output, so after the
+    masks are freed only the reconstruction and the output are alive.
+    """
+    t = time.perf_counter()
+    t0, t1, t2, t3 = thresholds
+    p = pad
+
+    wide = sitk.BinaryThreshold(img, t0, t3, 255, 0)
+    narrow = sitk.BinaryThreshold(img, t1, t2, 255, 0)
+    # with 255/0 masks the reconstruction is already 255/0
+    recon = sitk.ReconstructionByDilationImageFilter()
+    recon.UseInternalCopyOff()
+    result = recon.Execute(narrow, wide)
+    del wide, narrow
+
+    if medianRadius:
+        # the vote repeats the edge voxels, as sitk.Median does
+        result = majorityFilter(result, medianRadius, (0, 255), pad=p)
+    elif p:
+        result = sitk.ConstantPad(result, [p] * 3, [p] * 3)
+    elapsedTime(t)
+    return result
+
+
+#
+#  Connected components
+#
+
+
+def labelComponents(img, lower, upper=None, maxLabels=0, minSize=0, fullyConnected=False):
+    """
+    Label the connected regions of voxels in [lower, upper], numbered
+    1, 2, ... from the largest down.  Only the maxLabels largest
+    regions (0 for all) of at least minSize voxels are kept.  Returns
+    the smallest of a uint8, uint16 or uint32 label image that holds
+    the labels, and the list of region sizes.
+    """
+    t = time.perf_counter()
+    mask = img >= lower
+    if upper is not None:
+        mask = mask & (img <= upper)
+    labels = sitk.ConnectedComponent(mask, fullyConnected)
+    del mask
+
+    relabel = sitk.RelabelComponentImageFilter()
+    relabel.SetSortByObjectSize(True)
+    relabel.SetMinimumObjectSize(minSize)
+    labels = relabel.Execute(labels)
+    sizes = list(relabel.GetSizeOfObjectsInPixels())
+    if maxLabels and len(sizes) > maxLabels:
+        sizes = sizes[:maxLabels]
+        labels = sitk.Threshold(labels, 0, maxLabels, 0)
+    if len(sizes) < 256:
+        labels = sitk.Cast(labels, sitk.sitkUInt8)
+    elif len(sizes) < 65536:
+        labels = sitk.Cast(labels, sitk.sitkUInt16)
+    else:
+        labels = sitk.Cast(labels, sitk.sitkUInt32)
+
+    print("Connected components:", relabel.GetOriginalNumberOfObjects(),
+          "found,", len(sizes), "kept")
+    elapsedTime(t)
+    return labels, sizes
+
+
+def keepLargestComponents(img, lower, upper=None, count=1):
+    """
+    Keep the count largest connected regions of voxels in [lower, upper]
+    and set the voxels of the other regions to the image minimum, so
+    only the kept objects get contoured.  The voxels around the kept
+    regions are left as they are, which keeps their surfaces the same.
+    Regions are 26-connected, as a contour surface is.
+    """
+    t = time.perf_counter()
+    labels, sizes = labelComponents(img, lower, upper, count, fullyConnected=True)
+    removed = img >= lower
+    if upper is not None:
+        removed = removed & (img <= upper)
+    removed = removed & (labels == 0)
+    del labels
+
+    minmax = sitk.MinimumMaximumImageFilter()
+    minmax.Execute(img)
+    result = sitk.Mask(img, removed, minmax.GetMinimum(), 1)
+    print("Kept the", len(sizes), "largest components")
+    elapsedTime(t)
+    return result
+
+
+#
+#  Main (test code)
+#
+if __name__ == "__main__":
+    print("sitkutils.py")
+
+    try:
+        img = sitk.ReadImage(sys.argv[1])
+        img = autoCrop(img, float(sys.argv[3]))
+        sitk.WriteImage(img, sys.argv[2])
+    except:
+        print("Usage: sitkutils.py input_volume output_volume isovalue")
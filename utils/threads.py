@@ -0,0 +1,134 @@
+#! /usr/bin/env python
+
+"""
+Thread count control for the SimpleITK and VTK stages, and a report of
+how each stage of the pipeline scales with the number of threads.
+
+Usage: python -m utils.threads [max_threads] [volume_file]
+
+It is covered by the Apache License, Version 2.0:
+http://www.apache.org/licenses/LICENSE-2.0
+"""
+
+from __future__ import print_function
+import sys
+import os
+import time
+import SimpleITK as sitk
+import vtk
+
+
+def setNumberOfThreads(n=0):
+    """
+    Set the number of threads used by SimpleITK filters, VTK's
+    multithreader and VTK's SMP tools.  n <= 0 means all cores.
+    Returns the thread count that was set.
+    """
+    if n is None or n <= 0:
+        n = os.cpu_count() or 1
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(n)
+    vtk.vtkMultiThreader.SetGlobalMaximumNumberOfThreads(n)
+    try:
+        # the Sequential backend ignores the thread count
+        if n > 1 and vtk.vtkSMPTools.GetBackend() == "Sequential":
+            vtk.vtkSMPTools.SetBackend("STDThread")
+        vtk.vtkSMPTools.Initialize(n)
+    except:
+        print("Warning: can't set the VTK SMP thread count")
+    return n
+
+
+def getNumberOfThreads():
+    """The SimpleITK global default number of threads."""
+    return sitk.ProcessObject.GetGlobalDefaultNumberOfThreads()
+
+
+def _testVolume(size=[256, 256, 160]):
+    """A CT-like int16 volume: a bright shell in noisy soft tissue."""
+    center = [s/2.0 for s in size]
+    outer = sitk.GaussianSource(sitk.sitkFloat32, size, sigma=[s/5.0 for s in size],
+                                mean=center, scale=2000)
+    inner = sitk.GaussianSource(sitk.sitkFloat32, size, sigma=[s/6.0 for s in size],
+                                mean=center, scale=1500)
+    img = sitk.AdditiveGaussianNoise(outer - inner, 20, 0, 1)
+    return sitk.Cast(img, sitk.sitkInt16)
+
+
+def scalingReport(maxThreads=None, img=None, isovalue=300):
+    """
+    Time each stage of the pipeline at 1..maxThreads threads and print
+    a table of the times and speedups.  Returns a dict of stage name to
+    the list of times.
+    """
+    from utils import sitkutils
+    from utils import sitk2vtk
+    from utils import vtkutils
+
+    if maxThreads is None:
+        maxThreads = os.cpu_count() or 1
+    if img is None:
+        img = _testVolume()
+    thresholds = [isovalue, isovalue + 200, 4000, 5000]
+
+    def resample(data):
+        spacing = img.GetSpacing()
+        return sitkutils.resampleVolume(img, voxelSize=2*min(spacing))
+
+    def median(data):
+        return sitk.Median(img, [1, 1, 1])
+
+    def anisotropic(data):
+        return sitkutils.anisotropicDiffusion(img, .03, iterations=2)
+
+    def threshold(data):
+        data["mask"] = sitkutils.thresholdMedianPad(img, thresholds, [3, 3, 1])
+
+    def toVTK(data):
+        data["vtkimg"] = sitk2vtk.sitk2vtk(data["mask"])
+
+    def contour(data):
+        data["mesh"] = vtkutils.extractSurface(data["vtkimg"], 64.0)
+
+    def smooth(data):
+        data["smoothed"] = vtkutils.smoothMesh(data["mesh"], 25)
+
+    def reduce(data):
+        vtkutils.reduceMesh(data["smoothed"], .9)
+
+    stages = [("resample", resample), ("median", median), ("anisotropic", anisotropic),
+              ("threshold", threshold), ("sitk2vtk", toVTK), ("contour", contour),
+              ("smooth", smooth), ("reduce", reduce)]
+
+    oldThreads = getNumberOfThreads()
+    times = {}
+    for n in range(1, maxThreads + 1):
+        setNumberOfThreads(n)
+        data = {}
+        for name, func in stages:
+            t = time.perf_counter()
+            func(data)
+            times.setdefault(name, []).append(time.perf_counter() - t)
+    setNumberOfThreads(oldThreads)
+
+    print("")
+    print("Scaling report, volume", img.GetSize())
+    print("%-12s" % "threads" + "".join(["%10d" % n for n in range(1, maxThreads + 1)]))
+    for name, func in stages:
+        t = times[name]
+        print("%-12s" % name + "".join(["%10.3f" % x for x in t]))
+        print("%-12s" % "  speedup" + "".join(["%10.2f" % (t[0]/max(x, 1e-9)) for x in t]))
+    return times
+
+
+#
+#  Main (test code)
+#
+
+if __name__ == "__main__":
+    maxThreads = None
+    img = None
+    if len(sys.argv) > 1:
+        maxThreads = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        img = sitk.ReadImage(sys.argv[2])
+    scalingReport(maxThreads, img)
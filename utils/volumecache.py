@@ -0,0 +1,159 @@
+#! /usr/bin/env python
+
+"""
+A disk cache of decoded Dicom series.
+
+Each series is stored as a .npy array plus a .json file of its geometry
+and modality.  A cache hit still reads the whole array, what it saves is
+finding, parsing and decoding the Dicom slices.  Entries
+are keyed by SeriesInstanceUID and a checksum of the slice headers and
+file stats, so a changed series gets a new entry.  The cache is kept
+under a size cap by evicting the least recently used entries.
+
+It is covered by the Apache License, Version 2.0:
+http://www.apache.org/licenses/LICENSE-2.0
+"""
+
+from __future__ import print_function
+import os
+import time
+import json
+import hashlib
+import numpy as np
+import SimpleITK as sitk
+
+from utils import dicomutils
+
+DEFAULT_CACHE_SIZE = 20 * 1024**3
+
+
+def seriesKey(ss):
+    """
+    Cache key of a [series_uid, dir, sorted_files] series set: the
+    SeriesInstanceUID plus a checksum of the slice headers, sizes and
+    modification times.
+    """
+    h = hashlib.sha1()
+    for f in ss[2]:
+        st = os.stat(f)
+        h.update(json.dumps(dicomutils.getDicomTags(f), sort_keys=True).encode())
+        h.update(("%d %d\n" % (st.st_size, st.st_mtime_ns)).encode())
+    return ss[0] + "_" + h.hexdigest()[:16]
+
+
+def _entryFiles(cacheDir, key):
+    base = os.path.join(cacheDir, key)
+    return base + ".npy", base + ".json"
+
+
+def loadCachedVolume(cacheDir, key, chunk=16):
+    """
+    Load a cached volume.  Returns the image and its modality, or None
+    if the key isn't in the cache.
+
+    The image is allocated up front and the mapped array is pasted into
+    it chunk z-slices at a time, so the array is never copied whole.
+    """
+    npyName, jsonName = _entryFiles(cacheDir, key)
+    try:
+        with open(jsonName) as f:
+            meta = json.load(f)
+        arr = np.load(npyName, mmap_mode="r")
+    except:
+        return None
+
+    t = time.perf_counter()
+    isVector = meta["components"] > 1
+    img = None
+    for z0 in range(0, arr.shape[0], chunk):
+        piece = sitk.GetImageFromArray(np.ascontiguousarray(arr[z0:z0 + chunk]),
+                                       isVector=isVector)
+        if img is None:
+            img = sitk.Image([arr.shape[2], arr.shape[1], arr.shape[0]],
+                             piece.GetPixelID(), meta["components"])
+        img[:, :, z0:z0 + piece.GetSize()[2]] = piece
+    del arr
+    img.SetOrigin(meta["origin"])
+    img.SetSpacing(meta["spacing"])
+    img.SetDirection(meta["direction"])
+    # mark the entry as recently used
+    os.utime(jsonName)
+    print("Loaded cached volume", key, img.GetSize(),
+          str(round(time.perf_counter()-t, 3)), "seconds")
+    return img, meta["modality"]
+
+
+def storeCachedVolume(cacheDir, key, img, modality, maxBytes=DEFAULT_CACHE_SIZE):
+    """Store a volume in the cache, then evict entries over maxBytes."""
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir)
+    npyName, jsonName = _entryFiles(cacheDir, key)
+    meta = {"origin": list(img.GetOrigin()),
+            "spacing": list(img.GetSpacing()),
+            "direction": list(img.GetDirection()),
+            "components": img.GetNumberOfComponentsPerPixel(),
+            "modality": modality}
+
+    # write to temporary names, so a partial entry is never seen
+    np.save(npyName + ".tmp.npy", sitk.GetArrayViewFromImage(img))
+    with open(jsonName + ".tmp", "w") as f:
+        json.dump(meta, f)
+    os.replace(npyName + ".tmp.npy", npyName)
+    os.replace(jsonName + ".tmp", jsonName)
+
+    evictVolumeCache(cacheDir, maxBytes, keep=key)
+
+
+def evictVolumeCache(cacheDir, maxBytes=DEFAULT_CACHE_SIZE, keep=None):
+    """
+    Delete the least recently used entries until the cache is no larger
+    than maxBytes.  The keep entry is never deleted.
+    """
+    entries = []
+    total = 0
+    for name in os.listdir(cacheDir):
+        if not name.endswith(".json"):
+            continue
+        key = name[:-5]
+        npyName, jsonName = _entryFiles(cacheDir, key)
+        try:
+            size = os.path.getsize(npyName) + os.path.getsize(jsonName)
+            used = os.path.getmtime(jsonName)
+        except:
+            continue
+        entries.append((used, key, size))
+        total = total + size
+
+    entries.sort()
+    for used, key, size in entries:
+        if total <= maxBytes:
+            break
+        if key == keep:
+            continue
+        print("Evicting cached volume", key)
+        for f in _entryFiles(cacheDir, key):
+            try:
+                os.remove(f)
+            except:
+                pass
+        total = total - size
+    return total
+
+
+def loadSeriesSetCached(ss, cacheDir, maxBytes=DEFAULT_CACHE_SIZE, nworkers=1,
+                        pixelType=None):
+    """
+    dicomutils.loadSeriesSet, going through the volume cache in cacheDir.
+    """
+    key = seriesKey(ss)
+    if pixelType:
+        key = key + "_" + pixelType
+    result = loadCachedVolume(cacheDir, key)
+    if result is not None:
+        return result
+    img, modality = dicomutils.loadSeriesSet(ss, nworkers, pixelType)
+    try:
+        storeCachedVolume(cacheDir, key, img, modality, maxBytes)
+    except:
+        print("Warning: couldn't cache volume", key)
+    return img, modality
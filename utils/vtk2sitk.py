@@ -6,13 +6,22 @@ import vtk
 from vtk.util.numpy_support import *
 
 def vtk2sitk(vtkimg, debug=False):
-    """Takes a VTK image, returns a SimpleITK image."""
+    """
+    Takes a VTK image, returns a SimpleITK image with the same origin,
+    spacing and direction.  The pixels are copied once, since SimpleITK
+    can't wrap an outside buffer.
+    """
     sd = vtkimg.GetPointData().GetScalars()
     npdata = vtk_to_numpy(sd)
+    ncomp = sd.GetNumberOfComponents()
 
     dims = list(vtkimg.GetDimensions())
     origin = vtkimg.GetOrigin()
     spacing=vtkimg.GetSpacing()
+    direction = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0]
+    if hasattr(vtkimg, "GetDirectionMatrix"):
+        m = vtkimg.GetDirectionMatrix()
+        direction = [m.GetElement(r, c) for r in range(3) for c in range(3)]
 
     if debug:
         print("dims:", dims)
@@ -23,9 +32,13 @@ def vtk2sitk(vtkimg, debug=False):
         print("numpy shape:", npdata.shape)
 
     dims.reverse()
+    if ncomp > 1:
+        dims.append(ncomp)
     npdata.shape=tuple(dims)
     if debug:
         print("new shape:", npdata.shape)
-    sitkimg = sitk.GetImageFromArray(npdata)
+    sitkimg = sitk.GetImageFromArray(npdata, isVector=(ncomp > 1))
     sitkimg.SetSpacing(spacing)
+    sitkimg.SetOrigin(origin)
+    sitkimg.SetDirection(direction)
     return sitkimg
@@ -15,6 +15,7 @@ import sys
 import time
 import gc
 import traceback
+import concurrent.futures
 import vtk
 
 #
@@ -36,13 +37,102 @@ def elapsedTime(start_time):
 #
 
 
-def extractSurface(vol, isovalue=0.0):
-    """Extract an isosurface from a volume."""
+# isosurface engines, in order of preference for vtk versions that have them
+ENGINES = ["flyingedges", "synctemplates", "marchingcubes", "contour"]
+_autoEngine = None
+
+
+def surfaceFilter(engine):
+    """
+    A new isosurface filter for the named engine, or None if this
+    version of VTK doesn't have it.
+    """
+    names = {"flyingedges": "vtkFlyingEdges3D",
+             "synctemplates": "vtkSynchronizedTemplates3D",
+             "marchingcubes": "vtkMarchingCubes",
+             "contour": "vtkContourFilter"}
+    cls = getattr(vtk, names[engine], None)
+    if cls is None:
+        return None
+    iso = cls()
+    # the meshes get smoothed and decimated, so skip the per-point
+    # normals and scalars
+    iso.ComputeNormalsOff()
+    iso.ComputeScalarsOff()
+    if hasattr(iso, "ComputeGradientsOff"):
+        iso.ComputeGradientsOff()
+    return iso
+
+
+def _legacyFrame(vol):
+    """
+    A shallow copy of vol without a direction matrix.  Flying edges and
+    marching cubes apply the direction, contour and synchronized
+    templates don't, so every engine is given the same frame.
+    """
+    if not hasattr(vol, "GetDirectionMatrix") or vol.GetDirectionMatrix().IsIdentity():
+        return vol
+    plain = vtk.vtkImageData()
+    plain.ShallowCopy(vol)
+    plain.SetDirectionMatrix(1, 0, 0, 0, 1, 0, 0, 0, 1)
+    return plain
+
+
+def pickEngine():
+    """
+    Pick the fastest isosurface engine with a micro-benchmark on a
+    synthetic 96 cubed volume.  The choice is cached for the process.
+    """
+    global _autoEngine
+    if _autoEngine is not None:
+        return _autoEngine
+
+    source = vtk.vtkRTAnalyticSource()
+    source.SetWholeExtent(-48, 47, -48, 47, -48, 47)
+    source.Update()
+    vol = source.GetOutput()
+
+    best = None
+    for engine in ENGINES:
+        iso = surfaceFilter(engine)
+        if iso is None:
+            continue
+        iso.SetInputData(vol)
+        iso.SetValue(0, 150.0)
+        dt = None
+        for i in range(2):
+            t = time.perf_counter()
+            iso.Modified()
+            iso.Update()
+            x = time.perf_counter() - t
+            dt = x if dt is None else min(dt, x)
+        if best is None or dt < best[0]:
+            best = (dt, engine)
+    _autoEngine = best[1]
+    print("Isosurface engine:", _autoEngine)
+    return _autoEngine
+
+
+def extractSurface(vol, isovalue=0.0, engine="auto"):
+    """
+    Extract an isosurface from a volume.
+
+    engine is one of ENGINES, or "auto" for the fastest one (see
+    pickEngine).  All engines give the same surface.  If isovalue is a
+    list, a list of meshes is returned (see extractSurfaces).
+    """
+    if isinstance(isovalue, (list, tuple)):
+        return extractSurfaces(vol, isovalue, engine)
     try:
         t = time.perf_counter()
-        iso = vtk.vtkContourFilter()
+        if engine == "auto":
+            engine = pickEngine()
+        iso = surfaceFilter(engine)
+        if iso is None:
+            print("Isosurface engine", engine, "isn't available, using contour")
+            iso = surfaceFilter("contour")
         if vtk.vtkVersion.GetVTKMajorVersion() >= 6:
-            iso.SetInputData(vol)
+            iso.SetInputData(_legacyFrame(vol))
         else:
             iso.SetInput(vol)
         iso.SetValue(0, isovalue)
@@ -61,11 +151,184 @@ def extractSurface(vol, isovalue=0.0):
     return None
 
 
+def extractSurfaces(vol, isovalues, engine="auto", nworkers=None):
+    """
+    Extract one isosurface per value from a volume, concurrently in a
+    pool of nworkers threads (default one per value, up to VTK's global
+    thread limit, see threads.setNumberOfThreads).  Returns the list of
+    meshes, in the order of isovalues.
+    """
+    if engine == "auto":
+        engine = pickEngine()
+    if nworkers is None:
+        nworkers = vtk.vtkMultiThreader.GetGlobalMaximumNumberOfThreads()
+        if nworkers <= 0:
+            nworkers = len(isovalues)
+    nworkers = max(1, min(nworkers, len(isovalues)))
+    with concurrent.futures.ThreadPoolExecutor(nworkers) as pool:
+        return list(pool.map(lambda v: extractSurface(vol, v, engine), isovalues))
+
+
+def extractSurfaceStreamed(readSlab, dims, spacing, origin=(0.0, 0.0, 0.0),
+                           isovalue=0.0, slab=64, pad=5, padValue=0, engine="auto"):
+    """
+    Extract an isosurface slab by slab, from a volume too large to hold
+    in memory.
+
+    readSlab(z0, z1) returns slices z0 to z1-1 of the volume as a z,y,x
+    numpy array, and dims is the x,y,z size of the volume.  The volume
+    is padded with pad voxels of padValue on every side, as ConstantPad
+    does in dicom2stl.py.  Consecutive slabs share one slice, so the
+    vertices on a seam plane come out the same from both slabs and are
+    merged into one mesh.  Peak memory is a slab plus the mesh.
+
+    If isovalue is a list, every value is contoured from each slab, so
+    the volume is read once, and a list of meshes is returned.
+    """
+    import numpy as np
+    from vtk.util import numpy_support
+
+    t = time.perf_counter()
+    if engine == "auto":
+        engine = pickEngine()
+    if surfaceFilter(engine) is None:
+        print("Isosurface engine", engine, "isn't available, using contour")
+        engine = "contour"
+    nx, ny, nz = dims
+    X, Y, Z = nx + 2*pad, ny + 2*pad, nz + 2*pad
+    porigin = [o - pad*s for o, s in zip(origin, spacing)]
+    slab = max(1, slab)
+    values = isovalue if isinstance(isovalue, (list, tuple)) else [isovalue]
+
+    appends = [vtk.vtkAppendPolyData() for v in values]
+    nslabs = 0
+    a = 0
+    while a < Z - 1:
+        b = min(a + slab, Z - 1)
+        data = None
+        lo = max(a - pad, 0)
+        hi = min(b - pad, nz - 1)
+        if lo <= hi:
+            slices = readSlab(lo, hi + 1)
+            data = np.full((b - a + 1, Y, X), padValue, dtype=slices.dtype)
+            data[lo + pad - a:hi + pad - a + 1, pad:pad + ny, pad:pad + nx] = slices
+            slices = None
+
+        if data is not None:
+            vol = vtk.vtkImageData()
+            vol.SetExtent(0, X - 1, 0, Y - 1, a, b)
+            vol.SetOrigin(porigin)
+            vol.SetSpacing(spacing)
+            arr = numpy_support.numpy_to_vtk(data.reshape(-1), deep=False)
+            vol.GetPointData().SetScalars(arr)
+
+            for append, value in zip(appends, values):
+                iso = surfaceFilter(engine)
+                iso.SetInputData(vol)
+                iso.SetValue(0, value)
+                iso.Update()
+                piece = vtk.vtkPolyData()
+                piece.ShallowCopy(iso.GetOutput())
+                append.AddInputData(piece)
+            iso = vol = arr = data = None
+            nslabs = nslabs + 1
+        a = b
+
+    meshes = []
+    for append in appends:
+        if nslabs == 0:
+            meshes.append(vtk.vtkPolyData())
+            continue
+        # merge the seam vertices
+        if hasattr(vtk, "vtkStaticCleanPolyData"):
+            clean = vtk.vtkStaticCleanPolyData()
+        else:
+            clean = vtk.vtkCleanPolyData()
+        clean.SetInputConnection(append.GetOutputPort())
+        clean.SetTolerance(0.0)
+        clean.Update()
+        meshes.append(clean.GetOutput())
+    print("Surface extracted in", nslabs, "slabs")
+    print("    ", [m.GetNumberOfPolys() for m in meshes], "polygons")
+    elapsedTime(t)
+    if isinstance(isovalue, (list, tuple)):
+        return meshes
+    return meshes[0]
+
+
+def boundaryEdges(mesh):
+    """
+    Number of boundary and non-manifold edges of a mesh.  A watertight
+    mesh has none.
+    """
+    edges = vtk.vtkFeatureEdges()
+    edges.SetInputData(mesh)
+    edges.BoundaryEdgesOn()
+    edges.NonManifoldEdgesOn()
+    edges.FeatureEdgesOff()
+    edges.ManifoldEdgesOff()
+    edges.Update()
+    return edges.GetOutput().GetNumberOfLines()
+
+
+def extractLabelSurfaces(vol, labels):
+    """
+    Extract the surface of each label of a label map in one discrete
+    contouring pass, with surface nets, or discrete marching cubes on
+    older versions of VTK.  Returns a list of meshes in the order of
+    labels.  Two touching labels share the faces between them.
+    """
+    t = time.perf_counter()
+    if hasattr(vtk, "vtkSurfaceNets3D"):
+        iso = vtk.vtkSurfaceNets3D()
+        iso.SetOutputMeshTypeToTriangles()
+        # the meshes get smoothed later
+        iso.SmoothingOff()
+        arrayName = "BoundaryLabels"
+    else:
+        iso = vtk.vtkDiscreteMarchingCubes()
+        iso.ComputeNormalsOff()
+        iso.ComputeGradientsOff()
+        arrayName = "Scalars"
+    iso.SetInputData(_legacyFrame(vol))
+    for i, label in enumerate(labels):
+        iso.SetValue(i, label)
+    iso.Update()
+    surface = iso.GetOutput()
+    print("Label surfaces extracted,", len(labels), "labels")
+    print("    ", surface.GetNumberOfPolys(), "polygons")
+
+    meshes = []
+    for label in labels:
+        # the faces with label on either side
+        select = vtk.vtkThreshold()
+        select.SetInputData(surface)
+        select.SetInputArrayToProcess(0, 0, 0, vtk.vtkDataObject.FIELD_ASSOCIATION_CELLS,
+                                      arrayName)
+        select.SetComponentModeToUseAny()
+        select.SetLowerThreshold(label)
+        select.SetUpperThreshold(label)
+        select.SetThresholdFunction(vtk.vtkThreshold.THRESHOLD_BETWEEN)
+        geometry = vtk.vtkGeometryFilter()
+        geometry.SetInputConnection(select.GetOutputPort())
+        geometry.Update()
+        mesh = geometry.GetOutput()
+        mesh.GetCellData().Initialize()
+        mesh.GetPointData().Initialize()
+        meshes.append(mesh)
+    elapsedTime(t)
+    return meshes
+
+
 #
 #  Mesh filtering
 #
 def cleanMesh(mesh, connectivityFilter=False):
-    """Clean a mesh using VTK's CleanPolyData filter."""
+    """
+    Clean a mesh using VTK's CleanPolyData filter.  With connectivityFilter
+    only the largest connected region is kept, or that many of the largest
+    regions if it's a number greater than 1.
+    """
     try:
         t = time.perf_counter()
         connect = vtk.vtkPolyDataConnectivityFilter()
@@ -76,7 +339,17 @@ def cleanMesh(mesh, connectivityFilter=False):
                 connect.SetInputData(mesh)
             else:
                 connect.SetInput(mesh)
-            connect.SetExtractionModeToLargestRegion()
+            if connectivityFilter == 1:
+                connect.SetExtractionModeToLargestRegion()
+            else:
+                connect.SetExtractionModeToAllRegions()
+                connect.Update()
+                sizes = connect.GetRegionSizes()
+                regions = sorted(range(sizes.GetNumberOfTuples()),
+                                 key=lambda i: -sizes.GetValue(i))
+                connect.SetExtractionModeToSpecifiedRegions()
+                for i in regions[:int(connectivityFilter)]:
+                    connect.AddSpecifiedRegion(i)
             clean.SetInputConnection(connect.GetOutputPort())
         else:
             if vtk.vtkVersion.GetVTKMajorVersion() >= 6: